@@ -0,0 +1,451 @@
+""" Micro-benchmarks for core.buffers. Run from the repository root, e.g.
+
+    python -m benchmarks.buffers memmap --size 1000000
+"""
+import tempfile
+import time
+import threading
+import multiprocessing
+
+import torch
+import numpy as np
+
+from core.buffers import ReplayBuffer
+from core.buffers import PrioritizedReplayBuffer
+from core.buffers import TorchReplayBuffer
+from core.buffers import SharedReplayBuffer
+from core.buffers import ThreadSafeReplayBuffer
+from core.buffers import Prefetcher
+from core.buffers import SequenceReplayBuffer
+from core.utils import allocation_profile
+
+def fill(buffer, num, seed=0):
+    """ Fills the first num slots of buffer with random transitions without going through store """
+    rng = np.random.default_rng(seed)
+    chunk = 100000
+    for start in range(0, num, chunk):
+        end = min(start + chunk, num)
+        n = end - start
+        values = (
+            rng.standard_normal((n,) + tuple(buffer.states.shape[1:]), dtype=np.float32),
+            rng.uniform(-1, 1, (n,) + tuple(buffer.actions.shape[1:])).astype(np.float32),
+            rng.standard_normal(n, dtype=np.float32),
+            rng.standard_normal((n,) + tuple(buffer.next_states.shape[1:]), dtype=np.float32),
+            (rng.random(n) < 0.01).astype(np.float32)
+        )
+        for field, x in zip(buffer._fields(), values):
+            if torch.is_tensor(field):
+                field[start:end] = torch.from_numpy(x).to(field.device)
+            else:
+                field[start:end] = x
+    buffer.size = num
+    buffer.index = num % buffer.max_size
+
+def time_calls(fn, iters, warmup=10):
+    """ Returns the mean and 99th percentile latency of fn() in microseconds """
+    for _ in range(warmup):
+        fn()
+    times = np.empty(iters)
+    for i in range(iters):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+    return times.mean() * 1e6, np.percentile(times, 99) * 1e6
+
+def bench_memmap(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares sample_torch latency of the in-RAM and the memory-mapped ReplayBuffer """
+    print(f"size={size} state_dim={state_dim} action_dim={action_dim} batch_size={batch_size}")
+    with tempfile.TemporaryDirectory() as path:
+        for name, kwargs in (("in-RAM", {}), ("memmap", {"path": path})):
+            buffer = ReplayBuffer(size, state_dim, action_dim, device, **kwargs)
+            fill(buffer, size)
+            mean, p99 = time_calls(lambda: buffer.sample_torch(batch_size), iters)
+            print(f"{name:>8}: sample_torch mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+            del buffer
+
+def bench_prioritized(size, state_dim, action_dim, batch_size, iters, device):
+    """ Times the sum-tree operations of PrioritizedReplayBuffer on a full buffer with random priorities """
+    print(f"size={size} batch_size={batch_size}")
+    buffer = PrioritizedReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    buffer.tree.update(np.arange(size), np.random.random_sample(size))
+    indices = buffer._sample_indices(batch_size)
+    td_errors = np.random.standard_normal(batch_size)
+    for name, fn in (("sample indices", lambda: buffer._sample_indices(batch_size)),
+                     ("update_priorities", lambda: buffer.update_priorities(indices, td_errors)),
+                     ("sample_torch", lambda: buffer.sample_torch(batch_size))):
+        mean, p99 = time_calls(fn, iters)
+        print(f"{name:>18}: mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+
+def bench_device(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares sample_torch latency of the numpy ReplayBuffer and the device-resident TorchReplayBuffer """
+    print(f"size={size} batch_size={batch_size} device={device}")
+    for name, cls in (("numpy", ReplayBuffer), ("torch", TorchReplayBuffer)):
+        buffer = cls(size, state_dim, action_dim, device)
+        fill(buffer, size)
+        mean, p99 = time_calls(lambda: buffer.sample_torch(batch_size), iters)
+        print(f"{name:>8}: sample_torch mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+        del buffer
+
+def bench_zero_copy(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares latency and heap allocations of sample_torch with and without a preallocated ReplayBatch """
+    print(f"size={size} batch_size={batch_size} device={device}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    batch = buffer.allocate_batch(batch_size)
+    for name, fn in (("allocating", lambda: buffer.sample_torch(batch_size)),
+                     ("out=batch", lambda: buffer.sample_torch(batch_size, out=batch))):
+        mean, p99 = time_calls(fn, iters)
+        peak, retained = allocation_profile(fn, iters)
+        print(f"{name:>10}: sample_torch mean {mean:8.1f}us \t p99 {p99:8.1f}us \t "
+              f"peak alloc/call {peak:7d}B \t retained {retained:6d}B")
+
+def td3_update_step(actor, critics, target_actor, target_critics, optimizers, batch, polyak=0.995):
+    """ One step of the update loop of td3.train on batch: smoothed target actions, clipped double-Q targets,
+        both critic steps, then the actor step and the polyak averaging of the targets """
+    states, actions, rewards, next_states, dones = batch
+    noise = torch.clamp(0.2 * torch.randn_like(actions), -0.5, 0.5)
+    target_actions = torch.clamp(target_actor(next_states) + noise, -1.0, 1.0)
+    target_inputs = torch.cat([next_states, target_actions], 1)
+    target_qs = torch.min(*(critic(target_inputs).squeeze(1) for critic in target_critics))
+    target_qs = (rewards + 0.99 * (1.0 - dones) * target_qs).detach()
+    for critic, optimizer in zip(critics, optimizers):
+        loss = torch.mean((critic(torch.cat([states, actions], 1)).squeeze(1) - target_qs) ** 2)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    actor_loss = -torch.mean(critics[0](torch.cat([states, actor(states)], 1)))
+    optimizers[-1].zero_grad()
+    actor_loss.backward()
+    optimizers[-1].step()
+    for net, target in zip((actor,) + critics, (target_actor,) + target_critics):
+        for param, target_param in zip(net.parameters(), target.parameters()):
+            target_param.data.copy_(polyak * target_param.data + (1.0 - polyak) * param.data)
+
+def bench_update(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares latency and heap allocations of whole TD3 update steps, sampling with and without a
+        preallocated ReplayBatch (--zero_copy of td3 and ddpg) """
+    print(f"size={size} batch_size={batch_size} device={device}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    batch = buffer.allocate_batch(batch_size)
+
+    torch.manual_seed(0)
+    def mlp(inputs, outputs):
+        return torch.nn.Sequential(
+            torch.nn.Linear(inputs, 400), torch.nn.ReLU(),
+            torch.nn.Linear(400, 300), torch.nn.ReLU(),
+            torch.nn.Linear(300, outputs)
+        ).to(device)
+    actor, target_actor = mlp(state_dim, action_dim), mlp(state_dim, action_dim)
+    critics = (mlp(state_dim + action_dim, 1), mlp(state_dim + action_dim, 1))
+    target_critics = (mlp(state_dim + action_dim, 1), mlp(state_dim + action_dim, 1))
+    optimizers = [torch.optim.Adam(net.parameters(), lr=3e-4) for net in critics + (actor,)]
+
+    for name, sample in (("allocating", lambda: buffer.sample_torch(batch_size)),
+                         ("out=batch", lambda: buffer.sample_torch(batch_size, out=batch))):
+        fn = lambda: td3_update_step(actor, critics, target_actor, target_critics, optimizers, sample())
+        mean, p99 = time_calls(fn, iters)
+        peak, retained = allocation_profile(fn, iters)
+        print(f"{name:>10}: update step mean {mean:8.1f}us \t p99 {p99:8.1f}us \t "
+              f"peak alloc/step {peak:7d}B \t retained {retained:6d}B")
+
+def bench_store_batch(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares inserting transitions one at a time with store against chunks of batch_size with store_batch """
+    num = batch_size * iters
+    print(f"transitions={num} chunk={batch_size}")
+    rng = np.random.default_rng(0)
+    data = (
+        rng.standard_normal((num, state_dim), dtype=np.float32),
+        rng.uniform(-1, 1, (num, action_dim)).astype(np.float32),
+        rng.standard_normal(num, dtype=np.float32),
+        rng.standard_normal((num, state_dim), dtype=np.float32),
+        (rng.random(num) < 0.01).astype(np.float32)
+    )
+
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    start = time.perf_counter()
+    for transition in zip(*data):
+        buffer.store(*transition)
+    store_time = time.perf_counter() - start
+
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    start = time.perf_counter()
+    for i in range(0, num, batch_size):
+        buffer.store_batch(*(x[i:i + batch_size] for x in data))
+    store_batch_time = time.perf_counter() - start
+
+    print(f"      store: {num / store_time:12.0f} transitions/s")
+    print(f"store_batch: {num / store_batch_time:12.0f} transitions/s")
+
+def bench_dtypes(size, state_dim, action_dim, batch_size, iters, device):
+    """ Reports bytes per transition, sample_torch latency and the round-trip error of states for each dtype schema """
+    print(f"size={size} state_dim={state_dim} action_dim={action_dim} batch_size={batch_size}")
+    schemas = (
+        ("float32", ReplayBuffer, {}),
+        ("float16 obs", ReplayBuffer, {"states": np.float16, "next_states": np.float16}),
+        ("float16 obs, uint8 done", ReplayBuffer, {"states": np.float16, "next_states": np.float16, "dones": np.uint8}),
+        ("bfloat16 obs (torch)", TorchReplayBuffer, {"states": "bfloat16", "next_states": "bfloat16"}),
+    )
+    for name, cls, dtypes in schemas:
+        buffer = cls(size, state_dim, action_dim, device, dtypes=dtypes)
+        fill(buffer, size)
+        nbytes = sum(x.element_size() * x.nelement() if torch.is_tensor(x) else x.nbytes for x in buffer._fields())
+
+        # states are filled with standard normal values, so this is the quantization error on unit-scale inputs
+        reference = np.random.default_rng(0).standard_normal((min(size, 100000), state_dim), dtype=np.float32)
+        stored = buffer.states[:len(reference)]
+        stored = stored.float().cpu().numpy() if torch.is_tensor(stored) else stored.astype(np.float32)
+        error = np.abs(stored - reference)
+
+        mean, p99 = time_calls(lambda: buffer.sample_torch(batch_size), iters)
+        print(f"{name:>24}: {nbytes / size:6.1f}B/transition \t state error max {error.max():.2e} "
+              f"mean {error.mean():.2e} \t sample_torch mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+        del buffer
+
+def shared_actor(buffer, num, seed):
+    """ Inserts num random transitions into a SharedReplayBuffer one at a time, like an actor stepping an env """
+    rng = np.random.default_rng(seed)
+    state_dim, action_dim = buffer.states.shape[1], buffer.actions.shape[1]
+    states = rng.standard_normal((num + 1, state_dim), dtype=np.float32)
+    actions = rng.uniform(-1, 1, (num, action_dim)).astype(np.float32)
+    for i in range(num):
+        buffer.store(states[i], actions[i], 0.0, states[i + 1], False)
+    buffer.close()
+
+def bench_shared(size, state_dim, action_dim, batch_size, iters, device, actors=4):
+    """ Measures insert throughput of actor processes and the learner's sampling rate while they insert """
+    print(f"size={size} batch_size={batch_size} actors={actors} transitions/actor={iters}")
+    buffer = SharedReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, batch_size)
+    batch = buffer.allocate_batch(batch_size)
+
+    mean, _ = time_calls(lambda: buffer.sample_torch(batch_size, out=batch), 1000)
+    print(f"    learner alone: {1e6 / mean:10.0f} batches/s")
+
+    processes = [multiprocessing.Process(target=shared_actor, args=(buffer, iters, seed)) for seed in range(actors)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    batches = 0
+    while any(process.is_alive() for process in processes):
+        buffer.sample_torch(batch_size, out=batch)
+        batches += 1
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"  with {actors} actors: {batches / elapsed:10.0f} batches/s \t "
+          f"{actors * iters / elapsed:10.0f} inserts/s \t size {buffer.size}")
+    buffer.close()
+    buffer.unlink()
+
+def bench_prefetch(size, state_dim, action_dim, batch_size, iters, device, prefetch=2):
+    """ Compares updates/s of a TD3-sized critic update with synchronous and prefetched sampling """
+    print(f"size={size} batch_size={batch_size} prefetch={prefetch} device={device}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    critic = torch.nn.Sequential(
+        torch.nn.Linear(state_dim + action_dim, 400), torch.nn.ReLU(),
+        torch.nn.Linear(400, 300), torch.nn.ReLU(),
+        torch.nn.Linear(300, 1)
+    ).to(device)
+    optimizer = torch.optim.Adam(critic.parameters(), lr=1e-3)
+
+    def update(states, actions, rewards, next_states, dones):
+        targets = rewards + 0.99 * (1.0 - dones) * critic(torch.cat([next_states, actions], 1)).squeeze(1).detach()
+        loss = torch.mean((critic(torch.cat([states, actions], 1)).squeeze(1) - targets) ** 2)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for name in ("synchronous", "prefetched"):
+        prefetcher = Prefetcher(buffer, batch_size, prefetch) if name == "prefetched" else None
+        sample = prefetcher.get if prefetcher is not None else lambda: buffer.sample_torch(batch_size)
+        if prefetcher is not None:
+            prefetcher.start(10 + iters)
+        for _ in range(10):
+            update(*sample())
+        start = time.perf_counter()
+        for _ in range(iters):
+            update(*sample())
+        elapsed = time.perf_counter() - start
+        if prefetcher is not None:
+            prefetcher.stop()
+        print(f"{name:>12}: {iters / elapsed:8.0f} updates/s")
+
+def bench_sample_many(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares drawing the iters batches of one update round one by one against a single sample_many block """
+    print(f"size={size} batch_size={batch_size} batches/round={iters} device={device}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    batch = buffer.allocate_batch(batch_size)
+
+    def one_by_one():
+        for _ in range(iters):
+            buffer.sample_torch(batch_size)
+
+    def one_by_one_out():
+        for _ in range(iters):
+            buffer.sample_torch(batch_size, out=batch)
+
+    def block():
+        for _ in zip(*(x.unbind(0) for x in buffer.sample_many(iters, batch_size))):
+            pass
+
+    for name, fn in (("sample_torch", one_by_one), ("sample_torch(out=)", one_by_one_out), ("sample_many", block)):
+        mean, p99 = time_calls(fn, 20, warmup=2)
+        print(f"{name:>18}: {mean / 1e3:8.1f}ms/round \t {mean / iters:6.1f}us/batch")
+
+def bench_sequences(size, state_dim, action_dim, batch_size, iters, device):
+    """ Times sample_sequences for a few lengths on a full buffer of 1000-step episodes """
+    print(f"size={size} batch_size={batch_size} episode length=1000")
+    buffer = SequenceReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    buffer.episode_steps[:] = np.arange(size) % 1000
+    for length in (1, 10, 50):
+        mean, p99 = time_calls(lambda: buffer.sample_sequences(batch_size, length), iters)
+        print(f"length {length:>3}: sample_sequences mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+
+def bench_snapshot(size, state_dim, action_dim, batch_size, iters, device):
+    """ Times a full save, an incremental save after iters new transitions and a load of a full buffer """
+    print(f"size={size} state_dim={state_dim} action_dim={action_dim} new transitions={iters}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        buffer.save(path)
+        print(f"       full save: {time.perf_counter() - start:8.3f}s")
+
+        for _ in range(iters):
+            buffer.store(rng.standard_normal(state_dim), rng.uniform(-1, 1, action_dim), 0.0,
+                         rng.standard_normal(state_dim), False)
+        start = time.perf_counter()
+        buffer.save(path)
+        print(f"incremental save: {time.perf_counter() - start:8.3f}s")
+
+        restored = ReplayBuffer(size, state_dim, action_dim, device)
+        start = time.perf_counter()
+        restored.load(path)
+        print(f"            load: {time.perf_counter() - start:8.3f}s")
+        mean, p99 = time_calls(lambda: restored.sample_torch(batch_size), 1000)
+        print(f"sample_torch after load: mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+
+def bench_threaded(size, state_dim, action_dim, batch_size, iters, device, actors=4):
+    """ Measures the cost of thread-safe stores and the insert and sampling rates with actor threads """
+    print(f"size={size} batch_size={batch_size} actors={actors} transitions/actor={iters}")
+    rng = np.random.default_rng(0)
+    states = rng.standard_normal((iters + 1, state_dim), dtype=np.float32)
+    actions = rng.uniform(-1, 1, (iters, action_dim)).astype(np.float32)
+
+    def actor(buffer):
+        for i in range(iters):
+            buffer.store(states[i], actions[i], 0.0, states[i + 1], False)
+
+    for cls in (ReplayBuffer, ThreadSafeReplayBuffer):
+        buffer = cls(size, state_dim, action_dim, device)
+        start = time.perf_counter()
+        actor(buffer)
+        print(f"{cls.__name__:>22}: store {iters / (time.perf_counter() - start):10.0f} transitions/s in one thread")
+
+    buffer = ThreadSafeReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, batch_size)
+    buffer.versions[:batch_size] = 2
+    batch = buffer.allocate_batch(batch_size)
+    threads = [threading.Thread(target=actor, args=(buffer,)) for _ in range(actors)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    batches = 0
+    while any(thread.is_alive() for thread in threads):
+        buffer.sample_torch(batch_size, out=batch)
+        batches += 1
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print(f"   with {actors} actor threads: {actors * iters / elapsed:10.0f} inserts/s \t "
+          f"{batches / elapsed:10.0f} batches/s")
+
+def bench_recent(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares sample_torch latency over the whole buffer and over windows of recent transitions """
+    print(f"size={size} batch_size={batch_size} device={device}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    batch = buffer.allocate_batch(batch_size)
+    for recent in (None, 100000, 10000):
+        buffer.recent = recent
+        mean, p99 = time_calls(lambda: buffer.sample_torch(batch_size, out=batch), iters)
+        print(f"recent={recent!s:>7}: sample_torch(out=) mean {mean:8.1f}us \t p99 {p99:8.1f}us")
+
+def bench_epochs(size, state_dim, action_dim, batch_size, iters, device):
+    """ Compares an iter_epochs epoch against the same number of sample_torch(out=) draws """
+    print(f"size={size} batch_size={batch_size} holdout_frac=0.1 device={device}")
+    buffer = ReplayBuffer(size, state_dim, action_dim, device)
+    fill(buffer, size)
+    epochs = buffer.iter_epochs(batch_size, 0.1)
+
+    start = time.perf_counter()
+    num_batches = sum(1 for _ in next(epochs))
+    epoch_time = time.perf_counter() - start
+
+    batch = buffer.allocate_batch(batch_size)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        buffer.sample_torch(batch_size, out=batch)
+    sample_time = time.perf_counter() - start
+
+    print(f"          epoch: {epoch_time:6.2f}s \t {epoch_time / num_batches * 1e6:6.1f}us/batch ({num_batches} batches)")
+    print(f"sample_torch(out=): {sample_time:6.2f}s \t {sample_time / num_batches * 1e6:6.1f}us/batch")
+    peak, retained = allocation_profile(lambda: sum(1 for _ in next(epochs)), steps=2, warmup=1)
+    print(f"epoch allocations: peak {peak}B \t retained {retained}B")
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", type=str, choices=["memmap", "prioritized", "device", "zero_copy", "store_batch",
+                                                              "dtypes", "shared", "prefetch",
+                                                              "sample_many", "sequences", "snapshot",
+                                                              "threaded", "recent", "epochs", "update"])
+    parser.add_argument("--size", type=int, default=1000000)
+    parser.add_argument("--state_dim", type=int, default=15)
+    parser.add_argument("--action_dim", type=int, default=3)
+    parser.add_argument("--bs", type=int, default=100)
+    parser.add_argument("--iters", type=int, default=2000)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--actors", type=int, default=4)
+    parser.add_argument("--prefetch", type=int, default=2)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.benchmark == "memmap":
+        bench_memmap(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "prioritized":
+        bench_prioritized(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "device":
+        bench_device(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "zero_copy":
+        bench_zero_copy(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "store_batch":
+        bench_store_batch(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "dtypes":
+        bench_dtypes(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "shared":
+        bench_shared(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device, args.actors)
+    elif args.benchmark == "prefetch":
+        bench_prefetch(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device, args.prefetch)
+    elif args.benchmark == "sample_many":
+        bench_sample_many(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "sequences":
+        bench_sequences(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "snapshot":
+        bench_snapshot(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "threaded":
+        bench_threaded(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device, args.actors)
+    elif args.benchmark == "recent":
+        bench_recent(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "epochs":
+        bench_epochs(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
+    elif args.benchmark == "update":
+        bench_update(args.size, args.state_dim, args.action_dim, args.bs, args.iters, device)
@@ -0,0 +1,62 @@
+""" Throughput of the sharded offline datasets in core.datasets. Run from the repository root, e.g.
+
+    python -m benchmarks.datasets --size 2000000 --shard_size 100000
+"""
+import tempfile
+import time
+
+import torch
+import numpy as np
+
+from core.buffers import ReplayBuffer
+from core.datasets import DatasetWriter
+from core.datasets import ShardedDataset
+
+def bench_datasets(size, state_dim, action_dim, shard_size, batch_size, device):
+    """ Reports transitions/s of writing a dataset, filling a ReplayBuffer from it and iterating minibatches """
+    print(f"size={size} state_dim={state_dim} action_dim={action_dim} shard_size={shard_size} "
+          f"batch_size={batch_size} device={device}")
+    rng = np.random.default_rng(0)
+    chunk = 100000
+    with tempfile.TemporaryDirectory() as path:
+        writer = DatasetWriter(path, state_dim, action_dim, shard_size=shard_size)
+        start = time.perf_counter()
+        for i in range(0, size, chunk):
+            n = min(chunk, size - i)
+            writer.store_batch(
+                rng.standard_normal((n, state_dim), dtype=np.float32),
+                rng.uniform(-1, 1, (n, action_dim)).astype(np.float32),
+                rng.standard_normal(n, dtype=np.float32),
+                rng.standard_normal((n, state_dim), dtype=np.float32),
+                (rng.random(n) < 0.01).astype(np.float32)
+            )
+        writer.close()
+        # generating the data is part of this number
+        print(f"                    write: {size / (time.perf_counter() - start):12.0f} transitions/s")
+
+        dataset = ShardedDataset(path, device)
+        for shuffle in (False, True):
+            buffer = ReplayBuffer(size, state_dim, action_dim, device)
+            start = time.perf_counter()
+            dataset.fill(buffer, shuffle=shuffle)
+            print(f"      fill (shuffle={shuffle!s:>5}): {size / (time.perf_counter() - start):12.0f} transitions/s")
+            del buffer
+
+        for shuffle in (False, True):
+            start = time.perf_counter()
+            for batch in dataset.iter_batches(batch_size, shuffle=shuffle):
+                pass
+            print(f"iter_batches (shuffle={shuffle!s:>5}): {size / (time.perf_counter() - start):12.0f} transitions/s")
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1000000)
+    parser.add_argument("--state_dim", type=int, default=15)
+    parser.add_argument("--action_dim", type=int, default=3)
+    parser.add_argument("--shard_size", type=int, default=100000)
+    parser.add_argument("--bs", type=int, default=256)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    bench_datasets(args.size, args.state_dim, args.action_dim, args.shard_size, args.bs, torch.device(args.device))
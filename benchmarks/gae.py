@@ -0,0 +1,331 @@
+""" Micro-benchmarks for GAE and rewards-to-go (core.utils, core.buffers.GAEBuffer). Run from the repository root, e.g.
+
+    python -m benchmarks.gae cumsum
+"""
+import time
+import resource
+import multiprocessing
+
+import torch
+import numpy as np
+from torch.distributions import MultivariateNormal
+
+from core.buffers import GAEBuffer
+from core.buffers import VecGAEBuffer
+from core.buffers import MinibatchSampler
+from core.agents import GaussianPolicy
+from core.agents import ValueFunction
+from core.utils import discounted_cumsum_torch
+
+def discounted_cumsum_loop(x, discount):
+    """ The step-by-step loop discounted_cumsum_torch replaced, as the reference """
+    ret = torch.zeros_like(x)
+    ret[-1] = x[-1]
+    for t in range(len(x) - 2, -1, -1):
+        ret[t] = x[t] + discount * ret[t + 1]
+    return ret
+
+def timed(fn, min_time=0.2):
+    """ Returns the mean seconds per call of fn, over at least min_time seconds after one warmup call """
+    fn()
+    calls, start = 0, time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        fn()
+        calls += 1
+    return (time.perf_counter() - start) / calls
+
+def bench_cumsum(discount, device):
+    """ Compares discounted_cumsum_torch against the loop for trajectories of 10 to 100k steps """
+    print(f"discount={discount} device={device}")
+    for n in (10, 100, 1000, 10000, 100000):
+        x = torch.randn(n, device=device)
+        expected = discounted_cumsum_loop(x.double(), discount)
+        def error(ret):
+            return ((ret.double() - expected).abs() / (expected.abs() + 1)).max().item()
+
+        loop = timed(lambda: discounted_cumsum_loop(x, discount))
+        scan = timed(lambda: discounted_cumsum_torch(x, discount))
+        print(f"n={n:6d}: \t loop {loop * 1e6:10.1f}us \t scan {scan * 1e6:8.1f}us \t "
+              f"{loop / scan:7.1f}x \t max rel error vs float64: loop {error(discounted_cumsum_loop(x, discount)):.1e}, "
+              f"scan {error(discounted_cumsum_torch(x, discount)):.1e}")
+
+class ZeroAgent:
+    """ Stands in for the agent of a GAEBuffer, so the benchmarks time the buffer and not a network """
+    def evaluate(self, states, actions):
+        zeros = torch.zeros(len(states), device=states.device)
+        return zeros, zeros, zeros
+
+def bench_store(batch_size, state_dim, action_dim, ep_len, device):
+    """ Times filling a GAEBuffer step by step with store_numpy, against the per-step torch.tensor + store it did
+        before staging, including calc_trajectory at the end of every episode and get_buffer """
+    print(f"batch_size={batch_size} state_dim={state_dim} action_dim={action_dim} ep_len={ep_len} device={device}")
+    rng = np.random.default_rng(0)
+    states = rng.standard_normal((batch_size, state_dim))
+    actions = rng.standard_normal((batch_size, action_dim)).astype(np.float32)
+    rewards = rng.standard_normal(batch_size)
+    buffer = GAEBuffer(batch_size, 0.97, 0.99, state_dim, action_dim, ZeroAgent(), device)
+
+    def fill(store):
+        for i in range(batch_size):
+            store(states[i], actions[i], rewards[i])
+            if (i + 1) % ep_len == 0 or i == batch_size - 1:
+                buffer.calc_trajectory(0.0)
+        buffer.get_buffer()
+
+    def store_tensors(s, a, r):
+        buffer.store(torch.tensor(s), torch.tensor(a), r)
+
+    for name, store in (("torch.tensor + store", store_tensors), ("store_numpy", buffer.store_numpy)):
+        seconds = timed(lambda: fill(store), min_time=1.0)
+        print(f"{name:>20}: {seconds * 1e3:8.1f}ms per batch \t {seconds / batch_size * 1e6:6.2f}us per step")
+
+def bench_vec(num_steps, num_envs, state_dim, action_dim, ep_len, device):
+    """ Times the advantage math of a (num_steps, num_envs) rollout: VecGAEBuffer.calc_trajectory once, against
+        one GAEBuffer per environment with calc_trajectory at every episode end. The stores are not timed. """
+    print(f"num_steps={num_steps} num_envs={num_envs} ep_len~{ep_len} device={device}")
+    rng = np.random.default_rng(0)
+    states = rng.standard_normal((num_steps, num_envs, state_dim)).astype(np.float32)
+    actions = rng.standard_normal((num_steps, num_envs, action_dim)).astype(np.float32)
+    rewards = rng.standard_normal((num_steps, num_envs)).astype(np.float32)
+    dones = rng.random((num_steps, num_envs)) < 1.0 / ep_len
+    final_values = np.zeros(num_envs, dtype=np.float32)
+
+    vec = VecGAEBuffer(num_steps, num_envs, 0.97, 0.99, state_dim, action_dim, ZeroAgent(), device)
+    buffers = [GAEBuffer(num_steps, 0.97, 0.99, state_dim, action_dim, ZeroAgent(), device) for _ in range(num_envs)]
+
+    def fill():
+        vec.clear()
+        for t in range(num_steps):
+            vec.store_numpy(states[t], actions[t], rewards[t], dones[t])
+        for i, buffer in enumerate(buffers):
+            buffer.clear()
+            buffer.store_batch(states[:, i], actions[:, i], rewards[:, i])
+
+    def sequential():
+        for i, buffer in enumerate(buffers):
+            buffer.num = 0
+            for end in np.flatnonzero(dones[:, i]) + 1:
+                buffer.num = end
+                buffer.calc_trajectory(0.0)
+            if buffer.trajectory_start < num_steps:
+                buffer.num = num_steps
+                buffer.calc_trajectory(0.0)
+
+    for name, calc in (("GAEBuffer per episode", sequential), ("VecGAEBuffer", lambda: vec.calc_trajectory(final_values))):
+        total, rounds = 0.0, 0
+        while total < 1.0:
+            fill()
+            start = time.perf_counter()
+            calc()
+            total += time.perf_counter() - start
+            rounds += 1
+        print(f"{name:>21}: {total / rounds * 1e3:8.2f}ms per rollout")
+
+class MLPAgent(torch.nn.Module):
+    """ The policy and value networks of PPOAgent, without the training script's imports """
+    def __init__(self, state_dim, action_dim, hidden_layers):
+        super(MLPAgent, self).__init__()
+        self.policy = GaussianPolicy(state_dim, action_dim, hidden_layers, 0.5)
+        self.vf = ValueFunction(state_dim, hidden_layers)
+
+    def evaluate(self, states, actions):
+        means, covs = self.policy(states)
+        dist = MultivariateNormal(means, covs)
+        return torch.squeeze(self.vf(states)), dist.log_prob(actions), dist.entropy()
+
+    def sample_action_numpy(self, state, return_info=False):
+        state = torch.Tensor(state).to(self.vf.model[0].weight.device)
+        # same as PPOAgent.sample_action_numpy
+        with torch.no_grad():
+            mean, cov = self.policy(state)
+            if not return_info:
+                return MultivariateNormal(mean, cov).sample().cpu().numpy()
+            std = torch.sqrt(torch.diagonal(cov, dim1=-2, dim2=-1))
+            eps = torch.randn_like(mean)
+            log_prob = -0.5 * torch.sum(eps ** 2, -1) - torch.sum(torch.log(std), -1) - 0.5 * len(mean) * np.log(2 * np.pi)
+            action = mean + std * eps
+            out = torch.cat((action, log_prob.reshape(1), torch.squeeze(self.vf(state)).reshape(1))).cpu().numpy()
+        return out[:-2], float(out[-2]), float(out[-1])
+
+def bench_deferred(batch_size, state_dim, action_dim, ep_len, hidden_layers, device):
+    """ Times calc_trajectory at every episode end plus get_buffer, with a forward pass per trajectory against
+        a single deferred one. The stores are not timed. """
+    print(f"batch_size={batch_size} ep_len={ep_len} hidden_layers={hidden_layers} device={device}")
+    rng = np.random.default_rng(0)
+    states = rng.standard_normal((batch_size, state_dim)).astype(np.float32)
+    actions = rng.standard_normal((batch_size, action_dim)).astype(np.float32)
+    rewards = rng.standard_normal(batch_size).astype(np.float32)
+    ends = list(range(ep_len, batch_size, ep_len)) + [batch_size]
+    agent = MLPAgent(state_dim, action_dim, hidden_layers).to(device)
+
+    for deferred in (False, True):
+        buffer = GAEBuffer(batch_size, 0.97, 0.99, state_dim, action_dim, agent, device, deferred=deferred)
+        total, rounds = 0.0, 0
+        while total < 1.0:
+            buffer.store_batch(states, actions, rewards)
+            start = time.perf_counter()
+            buffer.trajectory_start = 0
+            for end in ends:
+                buffer.num = end
+                buffer.calc_trajectory(0.0)
+            buffer.get_buffer()
+            total += time.perf_counter() - start
+            rounds += 1
+        print(f"deferred={deferred!s:>5}: {total / rounds * 1e3:8.2f}ms per batch ({len(ends)} trajectories)")
+
+def bench_collect(batch_size, state_dim, action_dim, ep_len, hidden_layers, device):
+    """ Times collecting a batch the way ppo.train does (sample_action_numpy, store_numpy, calc_trajectory at every
+        episode end, get_buffer), with the log probs and values evaluated again by the buffer against stored
+        from sampling """
+    print(f"batch_size={batch_size} ep_len={ep_len} hidden_layers={hidden_layers} device={device}")
+    rng = np.random.default_rng(0)
+    states = rng.standard_normal((batch_size, state_dim)).astype(np.float32)
+    agent = MLPAgent(state_dim, action_dim, hidden_layers).to(device)
+
+    def collect(buffer, return_info):
+        for i in range(batch_size):
+            if return_info:
+                a, log_prob, value = agent.sample_action_numpy(states[i], return_info=True)
+                buffer.store_numpy(states[i], a, 0.0, log_prob, value)
+            else:
+                buffer.store_numpy(states[i], agent.sample_action_numpy(states[i]), 0.0)
+            if (i + 1) % ep_len == 0 or i == batch_size - 1:
+                buffer.calc_trajectory(0.0)
+        buffer.get_buffer()
+
+    for deferred in (False, True):
+        buffer = GAEBuffer(batch_size, 0.97, 0.99, state_dim, action_dim, agent, device, deferred=deferred)
+        for return_info in (False, True):
+            seconds = timed(lambda: collect(buffer, return_info), min_time=2.0)
+            print(f"deferred={deferred!s:>5} return_info={return_info!s:>5}: {seconds * 1e3:8.1f}ms per batch")
+
+def ppo_update_step(agent, optimizer, batch, target_kl=None):
+    """ update_step of ppo.train: one step of the PPO loss on batch, returns False without a step once the
+        approximate KL from the old policy exceeds 1.5 * target_kl """
+    old_states, old_actions, old_rewards, old_advs, old_log_probs = batch
+    values, log_probs, entropy = agent.evaluate(old_states, old_actions)
+    if target_kl is not None and torch.mean(old_log_probs - log_probs).item() > 1.5 * target_kl:
+        return False
+    ratios = torch.exp(log_probs - old_log_probs)
+    bounds = torch.where(old_advs > 0, 1.2 * old_advs, 0.8 * old_advs)
+    loss = torch.mean(-torch.min(ratios * old_advs, bounds) + 0.5 * (values - old_rewards) ** 2 - 0.01 * entropy)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return True
+
+def _ppo_updates(batch_size, state_dim, action_dim, hidden_layers, minibatch_size, min_time, results):
+    """ Runs PPO update steps (the loss of ppo.train) on a random batch for min_time seconds and puts
+        (steps, transitions, seconds, peak rss in bytes) in results. Runs in its own process, for its own peak RSS. """
+    torch.manual_seed(0)
+    agent = MLPAgent(state_dim, action_dim, hidden_layers)
+    optimizer = torch.optim.Adam(agent.parameters(), lr=3e-4)
+    batch = (
+        torch.randn(batch_size, state_dim), torch.randn(batch_size, action_dim), torch.randn(batch_size),
+        torch.randn(batch_size), torch.randn(batch_size) - 3.0
+    )
+
+    def update_step(*b):
+        ppo_update_step(agent, optimizer, b)
+
+    sampler = MinibatchSampler(minibatch_size, torch.device("cpu")) if minibatch_size > 0 else None
+    steps, transitions, start = 0, 0, time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        if sampler is None:
+            update_step(*batch)
+            steps, transitions = steps + 1, transitions + batch_size
+        else:
+            for minibatch in sampler.epoch(batch):
+                update_step(*minibatch)
+                steps, transitions = steps + 1, transitions + minibatch_size
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in KiB on linux
+    results.put((steps, transitions, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+def bench_minibatch(state_dim, action_dim, hidden_layers, minibatch_size, min_time):
+    """ Reports update steps/s, transitions/s and peak RSS of full-batch PPO updates against minibatch epochs,
+        for batches of 4k to 1M transitions. Every configuration runs in a fresh process. """
+    print(f"state_dim={state_dim} action_dim={action_dim} hidden_layers={hidden_layers} "
+          f"minibatch_size={minibatch_size} min_time={min_time}s")
+    context = multiprocessing.get_context("spawn")
+    for batch_size in (4000, 32000, 256000, 1000000):
+        for mode, size in (("full batch", 0), ("minibatch", minibatch_size)):
+            results = context.Queue()
+            process = context.Process(target=_ppo_updates, args=(batch_size, state_dim, action_dim, hidden_layers,
+                                                                 size, min_time, results))
+            process.start()
+            steps, transitions, seconds, rss = results.get()
+            process.join()
+            print(f"bs={batch_size:7d} {mode:>10}: {steps / seconds:8.1f} updates/s \t "
+                  f"{transitions / seconds:10.0f} transitions/s \t peak rss {rss / 2 ** 20:7.1f} MiB")
+
+def bench_target_kl(batch_size, state_dim, action_dim, hidden_layers, update_steps, target_kl, rounds):
+    """ Runs rounds of update_steps full-batch PPO steps, without and with KL early stopping. Every round
+        samples a fresh batch from the current policy (so its KL starts at 0) with advantages that favour
+        a fixed direction of the actions, and reports the steps taken and the time of the update. """
+    print(f"batch_size={batch_size} hidden_layers={hidden_layers} update_steps={update_steps} target_kl={target_kl}")
+    direction = torch.randn(action_dim)
+    for kl in (None, target_kl):
+        torch.manual_seed(0)
+        agent = MLPAgent(state_dim, action_dim, hidden_layers)
+        optimizer = torch.optim.Adam(agent.parameters(), lr=3e-4)
+        steps, times = [], []
+        for _ in range(rounds):
+            states = torch.randn(batch_size, state_dim)
+            with torch.no_grad():
+                means, covs = agent.policy(states)
+                dist = MultivariateNormal(means, covs)
+                actions = dist.sample()
+                log_probs = dist.log_prob(actions)
+            advs = actions @ direction
+            batch = (states, actions, torch.zeros(batch_size), (advs - advs.mean()) / advs.std(), log_probs)
+
+            start = time.perf_counter()
+            taken = 0
+            while taken < update_steps and ppo_update_step(agent, optimizer, batch, kl):
+                taken += 1
+            times.append(time.perf_counter() - start)
+            steps.append(taken)
+        print(f"target_kl={kl!s:>5}: steps per round {steps} \t mean update time {np.mean(times) * 1e3:7.1f}ms")
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", type=str, choices=["cumsum", "store", "vec", "deferred", "collect",
+                                                               "minibatch", "target_kl"])
+    parser.add_argument("--discount", type=float, default=0.99)
+    parser.add_argument("--bs", type=int, default=4000)
+    parser.add_argument("--state_dim", type=int, default=15)
+    parser.add_argument("--action_dim", type=int, default=3)
+    parser.add_argument("--ep_len", type=int, default=1000)
+    parser.add_argument("--num_steps", type=int, default=512)
+    parser.add_argument("--num_envs", type=int, default=8)
+    parser.add_argument("--hidden_layers", type=str, default="[128, 64]")
+    parser.add_argument("--minibatch_size", type=int, default=256)
+    parser.add_argument("--min_time", type=float, default=3.0)
+    parser.add_argument("--update_steps", type=int, default=80)
+    parser.add_argument("--target_kl", type=float, default=0.01)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.benchmark == "cumsum":
+        bench_cumsum(args.discount, device)
+    elif args.benchmark == "store":
+        bench_store(args.bs, args.state_dim, args.action_dim, args.ep_len, device)
+    elif args.benchmark == "vec":
+        bench_vec(args.num_steps, args.num_envs, args.state_dim, args.action_dim, args.ep_len, device)
+    elif args.benchmark == "deferred":
+        hidden_layers = [int(x) for x in args.hidden_layers[1:-1].split(",") if x.strip() != ""]
+        bench_deferred(args.bs, args.state_dim, args.action_dim, args.ep_len, hidden_layers, device)
+    elif args.benchmark == "collect":
+        hidden_layers = [int(x) for x in args.hidden_layers[1:-1].split(",") if x.strip() != ""]
+        bench_collect(args.bs, args.state_dim, args.action_dim, args.ep_len, hidden_layers, device)
+    elif args.benchmark == "minibatch":
+        hidden_layers = [int(x) for x in args.hidden_layers[1:-1].split(",") if x.strip() != ""]
+        bench_minibatch(args.state_dim, args.action_dim, hidden_layers, args.minibatch_size, args.min_time)
+    elif args.benchmark == "target_kl":
+        hidden_layers = [int(x) for x in args.hidden_layers[1:-1].split(",") if x.strip() != ""]
+        bench_target_kl(args.bs, args.state_dim, args.action_dim, hidden_layers, args.update_steps, args.target_kl,
+                        args.rounds)
@@ -1,23 +1,141 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory
+
 import torch
 import numpy as np
 
 from core.utils import discounted_cumsum_torch
+from core.utils import discounted_cumsum_scan
+
+# storage dtype of each ReplayBuffer field, entries can be overridden with the dtypes argument
+DEFAULT_DTYPES = {
+    "states": np.float32,
+    "actions": np.float32,
+    "rewards": np.float32,
+    "next_states": np.float32,
+    "dones": np.float32
+}
+
+def snapshot_exists(path):
+    """ Returns whether the directory path holds a snapshot written by ReplayBuffer.save """
+    return os.path.exists(os.path.join(path, "snapshot.json"))
+
+def format_stats(stats):
+    """ Returns the dict of a buffer's stats() as one log line """
+    def micros(x):
+        return "-" if np.isnan(x) else f"{x:.1f}us"
+    return (f"buffer: {stats['size']}/{stats['max_size']} ({stats['fill_ratio']:.1%}), \t "
+            f"{stats['total_bytes'] / 2 ** 20:.1f} MiB, \t {stats['inserts_per_sec']:.0f} inserts/s, \t "
+            f"sample p50: {micros(stats['sample_p50_us'])}, p99: {micros(stats['sample_p99_us'])}")
+
+def _write_synced(filename, write):
+    """ Creates filename with write(f) and syncs it to disk before returning """
+    with open(filename, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _fsync_dir(path):
+    """ Syncs the entries of a directory, so that a rename in it survives a crash """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _nbytes(x):
+    return x.element_size() * x.nelement() if torch.is_tensor(x) else x.nbytes
 
 class ReplayBuffer:
-    """ Replay Buffer stores the experiences of the agent"""
-    def __init__(self, max_size, state_dim, action_dim, device):
+    """ Replay Buffer stores the experiences of the agent
+
+        By default the transitions are kept in RAM. If path is given, they are stored in memory-mapped .npy files
+        in that directory instead, so only the pages in use stay resident (in the OS page cache). A buffer that
+        already exists at path (e.g. from a crashed run) is reopened with its contents and write position.
+
+        dtypes overrides the storage dtype of some fields (see DEFAULT_DTYPES), e.g. float16 states and
+        next_states, uint8 dones or int32 discrete actions. sample returns the stored dtypes and sample_torch
+        casts everything to float32.
+
+        save and load write and restore snapshots of the buffer (see save).
+
+        stats returns the memory, fill rate and sample_torch latency of the buffer (see BufferStats).
+
+        If recent is set to a number of transitions, sampling only draws from that many of the most recently
+        stored ones (e.g. for Emphasizing Recent Experience, Wang & Ross, 2019). The window is counted back
+        from the write position, so it costs nothing extra. PrioritizedReplayBuffer ignores it.
+    """
+    # fields written to snapshots, by attribute name
+    field_names = ("states", "actions", "rewards", "next_states", "dones")
+    # number of transitions in one chunk of a snapshot
+    snapshot_chunk = 1 << 16
+
+    def __init__(self, max_size, state_dim, action_dim, device, path=None, dtypes=None):
         self.max_size = int(max_size)
+        self.device = device
+        self.dtypes = dict(DEFAULT_DTYPES, **(dtypes or {}))
+        self.path = path
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
 
-        self.states = np.zeros((self.max_size, state_dim), dtype=np.float32)
-        self.actions = np.zeros((self.max_size, action_dim), dtype=np.float32)
-        self.rewards = np.zeros(self.max_size, dtype=np.float32)
-        self.next_states = np.zeros((self.max_size, state_dim), dtype=np.float32)
-        self.dones = np.zeros(self.max_size, dtype=np.float32)
+        self._allocate_fields(state_dim, action_dim)
 
         self.size = 0
         self.index = 0
+        self.recent = None
+        self.split = None
+        self.metrics = BufferStats()
 
-        self.device = device
+        # size and index are mirrored on disk so that the buffer can be reopened
+        self.counters = None
+        if path is not None:
+            self.counters = self._allocate("counters", (2,), np.int64)
+            self.size, self.index = int(self.counters[0]), int(self.counters[1])
+
+        # chunks written to since the last snapshot, all of them until the first one
+        self.dirty = np.ones(-(-self.max_size // self.snapshot_chunk), dtype=np.bool_)
+        # (directory, generation, number of deltas) of the snapshot last saved or loaded
+        self.snapshot = None
+
+    def _allocate_fields(self, state_dim, action_dim):
+        self.states = self._allocate("states", (self.max_size, state_dim), self.dtypes["states"])
+        self.actions = self._allocate("actions", (self.max_size, action_dim), self.dtypes["actions"])
+        self.rewards = self._allocate("rewards", (self.max_size,), self.dtypes["rewards"])
+        self.next_states = self._allocate("next_states", (self.max_size, state_dim), self.dtypes["next_states"])
+        self.dones = self._allocate("dones", (self.max_size,), self.dtypes["dones"])
+
+    def _allocate(self, name, shape, dtype):
+        """ Returns a zero-initialized array for the given field, memory-mapped if the buffer has a path
+
+        Args:
+            name: name of the field, used as the file name
+            shape: shape of the array
+            dtype: numpy dtype of the array
+
+        Returns:
+            np.ndarray or np.memmap
+        """
+        if isinstance(dtype, str) and dtype == "bfloat16":
+            raise ValueError("numpy has no bfloat16, use TorchReplayBuffer to store bfloat16 fields")
+        if self.path is None:
+            return np.zeros(shape, dtype=dtype)
+
+        filename = os.path.join(self.path, f"{name}.npy")
+        if not os.path.exists(filename):
+            return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+        array = np.lib.format.open_memmap(filename, mode="r+")
+        if array.shape != shape or array.dtype != dtype:
+            raise ValueError(f"{filename} has shape {array.shape} and dtype {array.dtype}, "
+                             f"expected shape {shape} and dtype {np.dtype(dtype)}")
+        return array
 
     def store(self, s, a, r, next_s, done):
         self.states[self.index] = s
@@ -25,57 +143,1261 @@ class ReplayBuffer:
         self.rewards[self.index] = r
         self.next_states[self.index] = next_s
         self.dones[self.index] = done
-        if self.size < self.max_size:
-            self.size += 1
-        self.index = (self.index + 1) % self.max_size
+        self._advance()
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        """ Stores n transitions with slice assignment, same as calling store on each of them in order
+
+        Args:
+            states: (n, state_dim) array
+            actions: (n, action_dim) array
+            rewards: (n,) array
+            next_states: (n, state_dim) array
+            dones: (n,) array
+        """
+        self._write_ring(self.index, self._fields(), (states, actions, rewards, next_states, dones))
+        self._advance(len(states))
+
+    def _write_ring(self, start, fields, batch):
+        """ Writes the n rows of each array of batch into the matching field, from slot start on and wrapping
+            around the end of the ring, same slots as n calls to store starting at start """
+        n = len(batch[0])
+        # only the last max_size rows would survive
+        if n > self.max_size:
+            start = (start + n - self.max_size) % self.max_size
+            batch = tuple(x[n - self.max_size:] for x in batch)
+            n = self.max_size
+
+        # write up to the end of the ring, then wrap around to the start
+        first = min(n, self.max_size - start)
+        for field, x in zip(fields, batch):
+            self._write_rows(field, start, x[:first])
+            self._write_rows(field, 0, x[first:])
+
+    def _write_rows(self, field, start, rows):
+        field[start:start + len(rows)] = rows
+
+    def _advance(self, num=1):
+        """ Moves the write position num slots forward, overwriting the oldest ones once the buffer is full """
+        self._mark_dirty(self.index, num)
+        self.metrics.inserts += num
+        self.size = min(self.size + num, self.max_size)
+        self.index = (self.index + num) % self.max_size
+        if self.counters is not None:
+            self.counters[0] = self.size
+            self.counters[1] = self.index
+
+    def _mark_dirty(self, start, num):
+        # the slot at the new write position counts too, CompactReplayBuffer writes it ahead of time
+        end = start + num
+        chunk = self.snapshot_chunk
+        if num + 1 >= self.max_size:
+            self.dirty[:] = True
+        elif end < self.max_size:
+            self.dirty[start // chunk:end // chunk + 1] = True
+        else:
+            self.dirty[start // chunk:] = True
+            self.dirty[:(end - self.max_size) // chunk + 1] = True
+
+    def _fields(self):
+        return (self.states, self.actions, self.rewards, self.next_states, self.dones)
+
+    def _arrays(self):
+        """ Returns the preallocated arrays of the buffer by name, for stats """
+        return {name: getattr(self, name) for name in self.field_names}
+
+    def stats(self, reset=False):
+        """ Returns runtime statistics of the buffer
+
+        The counters behind them cost one addition per store and two clock reads per sample_torch, see
+        BufferStats. bytes is what the arrays take up, a memory-mapped buffer only keeps the pages in use resident.
+
+        Args:
+            reset: whether to restart the insert rate and latencies afterwards, so the next call covers only
+                what happened in between
+
+        Returns:
+            dict with bytes (per array), total_bytes, size, max_size, fill_ratio, inserts and inserts_per_sec
+            since the last reset, samples, and sample_p50_us and sample_p99_us of sample_torch
+        """
+        nbytes = {name: _nbytes(x) for name, x in self._arrays().items()}
+        stats = {
+            "bytes": nbytes,
+            "total_bytes": sum(nbytes.values()),
+            "size": self.size,
+            "max_size": self.max_size,
+            "fill_ratio": self.size / self.max_size
+        }
+        stats.update(self.metrics.summary())
+        if reset:
+            self.metrics.reset()
+        return stats
+
+    def save(self, path):
+        """ Writes a snapshot of the buffer to the directory path
+
+        A snapshot is a base of one .npy file per field, a list of deltas and snapshot.json, which names them
+        along with the write position. Saving again to the snapshot the buffer last saved or loaded only writes
+        the chunks of snapshot_chunk transitions that changed since then, as one new delta file, so frequent
+        snapshots of a large buffer are cheap. Any other save writes a new base, and so does the save after
+        which the deltas would add up to as many chunks as the buffer has.
+
+        Files named by snapshot.json are never modified: new files are written and synced first, then
+        snapshot.json is replaced atomically, and only then are the files it no longer names deleted. A crash
+        at any point leaves the previous or the new snapshot, never a mix of both.
+
+        Args:
+            path: directory of the snapshot, created if needed. Must not be the buffer's own path.
+        """
+        if self.path is not None and os.path.abspath(path) == os.path.abspath(self.path):
+            raise ValueError("the buffer is memory-mapped at this path already, use flush instead")
+        os.makedirs(path, exist_ok=True)
+        meta = None
+        if snapshot_exists(path):
+            with open(os.path.join(path, "snapshot.json")) as f:
+                meta = json.load(f)
+
+        # a delta only holds the chunks written since this buffer last saved or loaded the snapshot, so it is
+        # only valid on top of that same snapshot
+        chunks = np.flatnonzero(self.dirty)
+        incremental = meta is not None and self.snapshot == (os.path.abspath(path), meta["generation"],
+                                                             len(meta["deltas"]))
+        if not incremental or meta["delta_chunks"] + len(chunks) >= len(self.dirty):
+            generation = meta["generation"] + 1 if meta is not None else 0
+            meta = {"generation": generation, "deltas": [], "delta_chunks": 0}
+            for name in self.field_names:
+                _write_synced(os.path.join(path, f"{name}_{generation:05d}.npy"),
+                              lambda f, name=name: np.save(f, getattr(self, name)))
+        elif len(chunks) > 0:
+            chunk = self.snapshot_chunk
+            rows = np.concatenate([np.arange(i * chunk, min((i + 1) * chunk, self.max_size)) for i in chunks])
+            delta = f"delta_{meta['generation']:05d}_{len(meta['deltas']):05d}.npz"
+            arrays = {name: np.take(getattr(self, name), rows, axis=0) for name in self.field_names}
+            _write_synced(os.path.join(path, delta), lambda f: np.savez(f, rows=rows, **arrays))
+            meta["deltas"].append(delta)
+            meta["delta_chunks"] += len(chunks)
+
+        meta.update({"max_size": self.max_size, "size": self.size, "index": self.index})
+        _write_synced(os.path.join(path, "snapshot.json.tmp"), lambda f: f.write(json.dumps(meta).encode()))
+        os.replace(os.path.join(path, "snapshot.json.tmp"), os.path.join(path, "snapshot.json"))
+        _fsync_dir(path)
+
+        # files of earlier bases and their deltas. A buffer that loaded them keeps its mapping after the unlink
+        keep = {f"{name}_{meta['generation']:05d}.npy" for name in self.field_names} | set(meta["deltas"])
+        for filename in os.listdir(path):
+            if filename not in keep and (filename.startswith("delta_") or
+                                         any(filename.startswith(f"{name}_") for name in self.field_names)):
+                os.remove(os.path.join(path, filename))
+
+        self.dirty[:] = False
+        self.snapshot = (os.path.abspath(path), meta["generation"], len(meta["deltas"]))
+
+    def load(self, path):
+        """ Restores a snapshot written by save
+
+        The base fields are memory-mapped copy-on-write, so loading reads nothing up front beyond the deltas,
+        and only the pages that are sampled or overwritten are read from disk. Changes are never written back
+        to the snapshot except by saving to it again.
+
+        Args:
+            path: directory of the snapshot
+        """
+        if self.path is not None:
+            raise ValueError("the buffer is memory-mapped already, it is reopened from its own path")
+        with open(os.path.join(path, "snapshot.json")) as f:
+            meta = json.load(f)
+        if meta["max_size"] != self.max_size:
+            raise ValueError(f"snapshot at {path} has max_size {meta['max_size']}, expected {self.max_size}")
+
+        for name in self.field_names:
+            filename = os.path.join(path, f"{name}_{meta['generation']:05d}.npy")
+            array = np.lib.format.open_memmap(filename, mode="c")
+            expected = getattr(self, name)
+            if array.shape != expected.shape or array.dtype != expected.dtype:
+                raise ValueError(f"{filename} has shape {array.shape} and dtype {array.dtype}, "
+                                 f"expected shape {expected.shape} and dtype {expected.dtype}")
+            self._restore_field(name, array)
+
+        # the deltas go into the copy-on-write pages, the base files stay untouched
+        for delta in meta["deltas"]:
+            with np.load(os.path.join(path, delta)) as arrays:
+                rows = arrays["rows"]
+                for name in self.field_names:
+                    getattr(self, name)[rows] = arrays[name]
+
+        self.size, self.index = meta["size"], meta["index"]
+        self.dirty[:] = False
+        self.snapshot = (os.path.abspath(path), meta["generation"], len(meta["deltas"]))
+
+    def _restore_field(self, name, array):
+        setattr(self, name, array)
+
+    def flush(self):
+        """ Writes memory-mapped fields back to disk. Does nothing for an in-RAM buffer. """
+        if self.path is None:
+            return
+        for array in self._fields() + (self.counters,):
+            array.flush()
+
+    def _window(self):
+        """ Returns the number of most recent transitions that are sampled from """
+        return self.size if self.recent is None else min(int(self.recent), self.size)
+
+    def _sample_indices(self, num):
+        window = self._window()
+        if window == self.size:
+            return np.random.randint(0, self.size, size=num)
+        # k steps back from the newest transition
+        return (self.index - 1 - np.random.randint(0, window, size=num)) % self.max_size
+
+    def _gather(self, indices):
+        # np.take is several times faster than fancy indexing for rows of a 2d array
+        return tuple(np.take(x, indices, axis=0) for x in self._fields())
 
     def sample(self, num):
-        indices = np.random.randint(0, self.size, size=num)
-        return (
-            self.states[indices],
-            self.actions[indices],
-            self.rewards[indices],
-            self.next_states[indices],
-            self.dones[indices]
+        return self._gather(self._sample_indices(num))
+
+    def allocate_batch(self, num):
+        """ Returns a ReplayBatch of num transitions for sample_torch(num, out=batch) to fill in place """
+        return ReplayBatch(self._fields(), num, self.device)
+
+    def _sample_indices_into(self, batch):
+        # floor(u * window) with u in [0, 1), computed in the batch's own arrays
+        window = self._window()
+        batch.rng.random(out=batch.uniform)
+        batch.uniform *= window
+        np.copyto(batch.indices, batch.uniform, casting="unsafe")
+        if window < self.size:
+            np.subtract(self.index - 1 + self.max_size, batch.indices, out=batch.indices)
+            np.remainder(batch.indices, self.max_size, out=batch.indices)
+
+    def sample_torch(self, num, out=None):
+        """ Samples num transitions as torch tensors on the buffer's device
+
+        Args:
+            num: number of transitions
+            out: optional ReplayBatch from allocate_batch(num). If given, the batch is filled in place and its
+                tensors are returned, so no new arrays or tensors are allocated.
+
+        Returns:
+            tuple of (num, ...) tensors of states, actions, rewards, next_states and dones
+        """
+        start = time.perf_counter()
+        if out is None:
+            batch = tuple(torch.as_tensor(x).to(self.device, torch.float32) for x in self.sample(num))
+        else:
+            self._sample_indices_into(out)
+            self._gather_into(out)
+            batch = out.copy_to_device()
+        self.metrics.record_sample(time.perf_counter() - start)
+        return batch
+
+    def sample_many(self, num_batches, batch_size):
+        """ Samples num_batches batches at once with a single draw of indices and one gather per field
+
+        Args:
+            num_batches: number of batches, e.g. the number of update steps of a round
+            batch_size: number of transitions in each batch
+
+        Returns:
+            tuple of (num_batches, batch_size, ...) tensors on the buffer's device, block[i] is the i-th batch
+        """
+        indices = self._sample_indices(num_batches * batch_size)
+        return tuple(
+            torch.as_tensor(x.reshape((num_batches, batch_size) + tuple(x.shape[1:]))).to(self.device, torch.float32)
+            for x in self._gather(indices)
         )
 
-    def sample_torch(self, num):
-        indices = np.random.randint(0, self.size, size=num)
+    def iter_epochs(self, batch_size, holdout_frac=0.0):
+        """ Iterates over epochs without replacement of the transitions outside a fixed holdout split
+
+        Every epoch shuffles the training slots in place (one preallocated permutation, extended with the
+        slots filled since the previous epoch) and gathers them into one preallocated batch, so the tensors of
+        a batch are overwritten by the next one. The last len % batch_size transitions of each shuffled epoch
+        are skipped, different ones every epoch. See HoldoutSplit for the split and holdout for its data.
+
+        Args:
+            batch_size: number of transitions in each batch
+            holdout_frac: fraction of the slots held out of training
+
+        Returns:
+            endless iterator with one iterator of batches per epoch, each batch a tuple of (batch_size, ...)
+            tensors of states, actions, rewards, next_states and dones
+        """
+        if self.split is None or self.split.holdout_frac != holdout_frac:
+            self.split = HoldoutSplit(self.max_size, holdout_frac)
+        return self._iter_epochs(self.allocate_batch(batch_size))
+
+    def _iter_epochs(self, batch):
+        while True:
+            self.split.extend(self.size)
+            order = self.split.train[:self.split.num_train]
+            batch.rng.shuffle(order)
+            yield self._epoch(self._filter_slots(order), batch)
+
+    def _epoch(self, order, batch):
+        for start in range(0, len(order) - batch.num + 1, batch.num):
+            np.copyto(batch.indices, order[start:start + batch.num])
+            self._gather_into(batch)
+            yield batch.copy_to_device()
+
+    def _filter_slots(self, slots):
+        """ Returns the slots that hold a transition which can be gathered """
+        return slots
+
+    def holdout(self):
+        """ Returns the transitions in the holdout slots of the last iter_epochs split as float32 tensors """
+        self.split.extend(self.size)
+        slots = self._filter_slots(self.split.holdout[:self.split.num_holdout]).copy()
+        return tuple(torch.as_tensor(x).to(self.device, torch.float32) for x in self._gather(slots))
+
+    def _gather_into(self, batch):
+        for x, array in zip(self._fields(), batch.arrays):
+            # mode="raise" would make np.take buffer the output, the indices are in range anyway
+            np.take(x, batch.indices, axis=0, out=array, mode="clip")
+
+class CompactReplayBuffer(ReplayBuffer):
+    """ Replay Buffer which stores every observation once instead of in both states and next_states.
+
+        Within an episode the next state of slot i is the state of slot i + 1. When an episode ends, its final
+        next state is kept in one extra slot which is flagged as not starting a transition (valid[i] is False)
+        and is never sampled. A stored state continues the previous transition iff it equals (in the storage
+        dtype) the previous next state, so episode ends need no extra signal and sampled transitions are
+        bit-identical to those of ReplayBuffer. This costs one slot per episode but roughly halves the memory
+        of the buffer.
+    """
+    field_names = ("states", "actions", "rewards", "dones", "valid")
+
+    def _allocate_fields(self, state_dim, action_dim):
+        self.states = self._allocate("states", (self.max_size, state_dim), self.dtypes["states"])
+        self.actions = self._allocate("actions", (self.max_size, action_dim), self.dtypes["actions"])
+        self.rewards = self._allocate("rewards", (self.max_size,), self.dtypes["rewards"])
+        self.dones = self._allocate("dones", (self.max_size,), self.dtypes["dones"])
+        self.valid = self._allocate("valid", (self.max_size,), np.bool_)
+
+    def store(self, s, a, r, next_s, done):
+        # after the first store, the slot at index holds the next state of the previous transition. If s is a
+        # different state (a new episode), keep that slot as the episode's final state and move past it.
+        s = np.asarray(s, dtype=self.states.dtype)
+        if self.size > 0 and not np.array_equal(self.states[self.index], s):
+            self._advance()
+
+        self.states[self.index] = s
+        self.actions[self.index] = a
+        self.rewards[self.index] = r
+        self.dones[self.index] = done
+        self.valid[self.index] = True
+        self._advance()
+
+        self.states[self.index] = next_s
+        self.valid[self.index] = False
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        # whether each state continues the previous transition depends on the one before, so store in order
+        for transition in zip(states, actions, rewards, next_states, dones):
+            self.store(*transition)
+
+    def _fields(self):
+        return (self.states, self.actions, self.rewards, self.dones, self.valid)
+
+    def _sample_indices(self, num):
+        indices = super(CompactReplayBuffer, self)._sample_indices(num)
+        self._redraw_invalid(indices)
+        return indices
+
+    def _sample_indices_into(self, batch):
+        super(CompactReplayBuffer, self)._sample_indices_into(batch)
+        self._redraw_invalid(batch.indices)
+
+    def _filter_slots(self, slots):
+        return slots[self.valid[slots]]
+
+    def _redraw_invalid(self, indices):
+        # invalid slots are one per episode, so this rarely takes more than one round
+        invalid = ~self.valid[indices]
+        while invalid.any():
+            indices[invalid] = super(CompactReplayBuffer, self)._sample_indices(invalid.sum())
+            invalid = ~self.valid[indices]
+
+    def _gather(self, indices):
         return (
-            torch.FloatTensor(self.states[indices]).to(self.device).detach(),
-            torch.FloatTensor(self.actions[indices]).to(self.device).detach(),
-            torch.FloatTensor(self.rewards[indices]).to(self.device).detach(),
-            torch.FloatTensor(self.next_states[indices]).to(self.device).detach(),
-            torch.FloatTensor(self.dones[indices]).to(self.device).detach()
+            np.take(self.states, indices, axis=0),
+            np.take(self.actions, indices, axis=0),
+            np.take(self.rewards, indices, axis=0),
+            np.take(self.states, indices + 1, axis=0, mode="wrap"),
+            np.take(self.dones, indices, axis=0)
+        )
+
+    def allocate_batch(self, num):
+        batch = ReplayBatch((self.states, self.actions, self.rewards, self.states, self.dones), num, self.device)
+        batch.next_indices = np.zeros(num, dtype=np.int64)
+        return batch
+
+    def _gather_into(self, batch):
+        states, actions, rewards, next_states, dones = batch.arrays
+        np.add(batch.indices, 1, out=batch.next_indices)
+        np.take(self.states, batch.indices, axis=0, out=states, mode="clip")
+        np.take(self.actions, batch.indices, axis=0, out=actions, mode="clip")
+        np.take(self.rewards, batch.indices, axis=0, out=rewards, mode="clip")
+        np.take(self.states, batch.next_indices, axis=0, out=next_states, mode="wrap")
+        np.take(self.dones, batch.indices, axis=0, out=dones, mode="clip")
+
+class NStepReplayBuffer(ReplayBuffer):
+    """ Replay Buffer which aggregates n-step transitions at insert time.
+
+        A rolling window of the last n_step (s, a, r) is kept per environment. Each stored transition
+        (s_t, a_t, R, s_{t+k}, done, discount ** k) has R = sum_i discount ** i * r_{t+i} over k <= n_step steps,
+        so the target is R + discount ** k * (1 - done) * Q(s_{t+k}). k is only less than n_step at the end of an
+        episode. An episode ends when done is set, or when the next state stored for that environment is not the
+        last next state (e.g. truncation at max_ep_len), in which case the window is bootstrapped from it.
+
+        sample and sample_torch return the discounts as a sixth element.
+    """
+    field_names = ReplayBuffer.field_names + ("discounts",)
+
+    def __init__(self, max_size, state_dim, action_dim, device, n_step, discount, path=None, dtypes=None):
+        self.n_step = n_step
+        self.discount = discount
+        self.powers = discount ** np.arange(n_step)
+        super(NStepReplayBuffer, self).__init__(max_size, state_dim, action_dim, device, path=path, dtypes=dtypes)
+        # env_id -> (window of (s, a, r), last next state)
+        self.windows = {}
+
+    def _allocate_fields(self, state_dim, action_dim):
+        super(NStepReplayBuffer, self)._allocate_fields(state_dim, action_dim)
+        self.discounts = self._allocate("discounts", (self.max_size,), np.float32)
+
+    def _fields(self):
+        return super(NStepReplayBuffer, self)._fields() + (self.discounts,)
+
+    def store(self, s, a, r, next_s, done, env_id=0):
+        window, last_next_s = self.windows.get(env_id, (deque(), None))
+        s = np.array(s, dtype=np.float32)
+        next_s = np.array(next_s, dtype=np.float32)
+        if window and not np.array_equal(s, last_next_s):
+            self._flush(window, last_next_s, False)
+
+        window.append((s, a, r))
+        if len(window) == self.n_step:
+            self._emit(window, next_s, done)
+            window.popleft()
+        if done:
+            self._flush(window, next_s, True)
+        self.windows[env_id] = (window, next_s)
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        # the windows advance one step at a time
+        for transition in zip(states, actions, rewards, next_states, dones):
+            self.store(*transition)
+
+    def _emit(self, window, next_s, done):
+        """ Stores the n-step transition starting at the oldest step of window """
+        s, a, _ = window[0]
+        k = len(window)
+        reward = np.dot(self.powers[:k], [step[2] for step in window])
+        self.discounts[self.index] = self.discount ** k
+        super(NStepReplayBuffer, self).store(s, a, reward, next_s, done)
+
+    def _flush(self, window, next_s, done):
+        """ Stores the transitions of every step left in window at the end of an episode """
+        while window:
+            self._emit(window, next_s, done)
+            window.popleft()
+
+class SequenceReplayBuffer(ReplayBuffer):
+    """ Replay Buffer which tracks episode boundaries to sample contiguous sequences of transitions.
+
+        episode_steps[i] is the step of slot i within its episode, 0 at an episode start. A transition starts a
+        new episode if the previous one was done or if its state is not the previous next state (in the storage
+        dtype), e.g. after truncation at max_ep_len. A sequence of length k starting at slot i lies within one
+        episode iff episode_steps[i + k - 1] == episode_steps[i] + k - 1, and it does not cross the write head iff
+        at least k - 1 transitions were stored after slot i, so both checks are O(1) per sampled sequence.
+    """
+    field_names = ReplayBuffer.field_names + ("episode_steps",)
+
+    def _allocate_fields(self, state_dim, action_dim):
+        super(SequenceReplayBuffer, self)._allocate_fields(state_dim, action_dim)
+        self.episode_steps = self._allocate("episode_steps", (self.max_size,), np.int32)
+
+    def _episode_step(self, s):
+        """ Returns the step within its episode of a transition from state s stored at the current index """
+        if self.size == 0:
+            return 0
+        prev = (self.index - 1) % self.max_size
+        if self.dones[prev] or not np.array_equal(np.asarray(s, dtype=self.states.dtype), self.next_states[prev]):
+            return 0
+        return self.episode_steps[prev] + 1
+
+    def store(self, s, a, r, next_s, done):
+        self.episode_steps[self.index] = self._episode_step(s)
+        super(SequenceReplayBuffer, self).store(s, a, r, next_s, done)
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        states = np.asarray(states, dtype=self.states.dtype)
+        next_states = np.asarray(next_states, dtype=self.next_states.dtype)
+        n = len(states)
+        if n == 0:
+            return
+
+        # a row starts an episode if the row before it was done or does not lead to its state
+        starts = np.empty(n, dtype=np.bool_)
+        first = self._episode_step(states[0])
+        starts[0] = first == 0
+        starts[1:] = (np.asarray(dones[:-1]) != 0) | np.any(states[1:] != next_states[:-1], axis=1)
+        positions = np.arange(n)
+        last_start = np.maximum.accumulate(np.where(starts, positions, -1))
+        steps = np.where(last_start >= 0, positions - last_start, first + positions)
+
+        # same slots as ReplayBuffer.store_batch writes to
+        self._write_ring(self.index, (self.episode_steps,), (steps,))
+        super(SequenceReplayBuffer, self).store_batch(states, actions, rewards, next_states, dones)
+
+    def flush(self):
+        super(SequenceReplayBuffer, self).flush()
+        if self.path is not None:
+            self.episode_steps.flush()
+
+    def episode_starts(self):
+        """ Returns the slots of the transitions that start an episode """
+        return np.flatnonzero(self.episode_steps[:self.size] == 0)
+
+    def _valid_sequences(self, starts, length):
+        ends = (starts + length - 1) % self.max_size
+        before_head = (self.index - 1 - starts) % self.max_size >= length - 1
+        return before_head & (self.episode_steps[ends] == self.episode_steps[starts] + length - 1)
+
+    def _sample_sequence_starts(self, num, length, max_rounds=100):
+        if length > self.size:
+            raise ValueError(f"can not sample sequences of length {length} from {self.size} transitions")
+        starts = np.random.randint(0, self.size, size=num)
+        # starts too close to the end of an episode are redrawn, rarely more than a few rounds
+        for _ in range(max_rounds):
+            invalid = ~self._valid_sequences(starts, length)
+            if not invalid.any():
+                return starts
+            starts[invalid] = np.random.randint(0, self.size, size=invalid.sum())
+        raise ValueError(f"could not sample {num} sequences of length {length} within {max_rounds} rounds, "
+                         f"are the episodes in the buffer shorter than that?")
+
+    def sample_sequences(self, num, length):
+        """ Samples num sequences of length consecutive transitions, each within a single episode
+
+        Args:
+            num: number of sequences
+            length: number of transitions in each sequence
+
+        Returns:
+            tuple of (num, length, ...) tensors of states, actions, rewards, next_states and dones
+        """
+        starts = self._sample_sequence_starts(num, length)
+        indices = (starts[:, None] + np.arange(length)) % self.max_size
+        return tuple(
+            torch.as_tensor(np.take(x, indices, axis=0)).to(self.device, torch.float32) for x in self._fields()
+        )
+
+class ThreadSafeReplayBuffer(ReplayBuffer):
+    """ Replay Buffer that several collector threads can store into while a learner thread samples.
+
+        store and store_batch only hold a lock to move the write position (and size) forward, the copies into
+        the reserved slots happen outside of it. Every slot has a version, odd while it is being written and
+        even once written (0 if it never was). sample reads the versions of the drawn slots before and after
+        gathering them and redraws the slots that were being written or changed in between, so every returned
+        transition is one that was completely stored, like a seqlock.
+    """
+    def __init__(self, max_size, state_dim, action_dim, device, path=None, dtypes=None):
+        self.lock = threading.Lock()
+        super(ThreadSafeReplayBuffer, self).__init__(max_size, state_dim, action_dim, device, path=path,
+                                                     dtypes=dtypes)
+
+    def _allocate_fields(self, state_dim, action_dim):
+        super(ThreadSafeReplayBuffer, self)._allocate_fields(state_dim, action_dim)
+        self.versions = self._allocate("versions", (self.max_size,), np.int64)
+
+    def _reserve(self, num):
+        """ Atomically moves the write position num slots forward and returns the first reserved slot """
+        with self.lock:
+            start = self.index
+            self._advance(num)
+        return start
+
+    def store(self, s, a, r, next_s, done):
+        index = self._reserve(1)
+        self.versions[index] += 1
+        self.states[index] = s
+        self.actions[index] = a
+        self.rewards[index] = r
+        self.next_states[index] = next_s
+        self.dones[index] = done
+        self.versions[index] += 1
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        n = len(states)
+        start = self._reserve(n)
+        # every slot is written once, all of them if n >= max_size
+        slots = (start + np.arange(min(n, self.max_size))) % self.max_size
+        self.versions[slots] += 1
+        self._write_ring(start, self._fields(), (states, actions, rewards, next_states, dones))
+        self.versions[slots] += 1
+
+    def _arrays(self):
+        return dict(super(ThreadSafeReplayBuffer, self)._arrays(), versions=self.versions)
+
+    def _torn(self, indices, before):
+        return (before == 0) | (before % 2 == 1) | (before != np.take(self.versions, indices))
+
+    def _gather(self, indices):
+        before = np.take(self.versions, indices)
+        batch = super(ThreadSafeReplayBuffer, self)._gather(indices)
+        self._redraw_torn(indices, before, batch)
+        return batch
+
+    def _gather_into(self, batch):
+        before = np.take(self.versions, batch.indices)
+        super(ThreadSafeReplayBuffer, self)._gather_into(batch)
+        self._redraw_torn(batch.indices, before, batch.arrays)
+
+    def _redraw_torn(self, indices, before, arrays):
+        redo = np.flatnonzero(self._torn(indices, before))
+        while len(redo) > 0:
+            indices[redo] = self._sample_indices(len(redo))
+            before = np.take(self.versions, indices[redo])
+            for field, x in zip(self._fields(), arrays):
+                x[redo] = np.take(field, indices[redo], axis=0)
+            redo = redo[self._torn(indices[redo], before)]
+
+    def load(self, path):
+        # versions are not part of snapshots, every restored slot counts as written
+        super(ThreadSafeReplayBuffer, self).load(path)
+        self.versions[:] = 0
+        self.versions[:self.size] = 2
+
+class SharedReplayBuffer(ThreadSafeReplayBuffer):
+    """ Replay Buffer in shared memory (multiprocessing.shared_memory), so actors in other processes can insert
+        while the learner samples.
+
+        Pass the buffer to multiprocessing.Process as an argument: the child attaches to the same blocks by name
+        instead of copying them. size, index and the slot versions live in shared memory as well, and the lock
+        of ThreadSafeReplayBuffer is shared by all processes, so actors insert concurrently and samples never
+        return a partly written transition. The learner samples with the usual sample / sample_torch, and
+        sample_torch(num, out=batch) gathers straight from the shared arrays.
+
+        The process that created the buffer must call unlink once every process is done with it. Call close in
+        each process to detach.
+
+        start_method is the multiprocessing start method ("fork", "spawn", ...) of the actor processes, the
+        default one if None.
+
+        stats counts the inserts of the calling process only, size and fill ratio include every process.
+    """
+    def __init__(self, max_size, state_dim, action_dim, device, dtypes=None, start_method=None):
+        self.blocks = {}
+        self.owner = True
+        super(SharedReplayBuffer, self).__init__(max_size, state_dim, action_dim, device, dtypes=dtypes)
+        self.lock = multiprocessing.get_context(start_method).Lock()
+
+    def _allocate_fields(self, state_dim, action_dim):
+        super(SharedReplayBuffer, self)._allocate_fields(state_dim, action_dim)
+        # [size, index]
+        self.positions = self._allocate("positions", (2,), np.int64)
+
+    def _allocate(self, name, shape, dtype):
+        if isinstance(dtype, str) and dtype == "bfloat16":
+            raise ValueError("numpy has no bfloat16, use TorchReplayBuffer to store bfloat16 fields")
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        self.blocks[name] = (block, shape, dtype)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.fill(0)
+        return array
+
+    @property
+    def size(self):
+        return int(self.positions[0])
+
+    @size.setter
+    def size(self, value):
+        self.positions[0] = value
+
+    @property
+    def index(self):
+        return int(self.positions[1])
+
+    @index.setter
+    def index(self, value):
+        self.positions[1] = value
+
+    def save(self, path):
+        # writes by other processes are not tracked, so every snapshot is a full one
+        self.dirty[:] = True
+        super(SharedReplayBuffer, self).save(path)
+
+    def _restore_field(self, name, array):
+        # the fields have to stay in shared memory, so the snapshot is read in full
+        getattr(self, name)[:] = array
+
+    def __getstate__(self):
+        # the arrays are views of the blocks and are rebuilt from them, SharedMemory pickles as its name
+        state = {k: v for k, v in self.__dict__.items() if k not in self.blocks}
+        state["owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, (block, shape, dtype) in self.blocks.items():
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+    def close(self):
+        """ Detaches this process from the shared memory, the buffer can not be used afterwards """
+        for name in self.blocks:
+            # the views have to go before the blocks can be closed
+            self.__dict__.pop(name, None)
+        for block, _, _ in self.blocks.values():
+            block.close()
+
+    def unlink(self):
+        """ Frees the shared memory once every process has closed it, only called by the creating process """
+        if self.owner:
+            for block, _, _ in self.blocks.values():
+                block.unlink()
+
+class ReplayBatch:
+    """ Preallocated output of ReplayBuffer.sample_torch(num, out=batch).
+
+        Transitions are gathered into numpy arrays that the torch tensors are views of (torch.from_numpy), so
+        filling a batch allocates nothing. Fields stored as something other than float32, or batches for a
+        non-CPU device, are copied (and cast) from the views into preallocated float32 tensors. Every call to
+        sample_torch overwrites the batch.
+    """
+    def __init__(self, fields, num, device):
+        self.num = num
+        # seeded from numpy so that runs seeded with np.random.seed stay reproducible
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31))
+        self.uniform = np.zeros(num)
+        self.indices = np.zeros(num, dtype=np.int64)
+
+        self.arrays = tuple(np.zeros((num,) + x.shape[1:], dtype=x.dtype) for x in fields)
+        self.host_tensors = tuple(torch.from_numpy(x) for x in self.arrays)
+        on_cpu = torch.device(device).type == "cpu"
+        self.tensors = tuple(
+            x if on_cpu and x.dtype == torch.float32 else torch.zeros(x.shape, device=device)
+            for x in self.host_tensors
         )
 
+    def copy_to_device(self):
+        for tensor, host_tensor in zip(self.tensors, self.host_tensors):
+            if tensor is not host_tensor:
+                tensor.copy_(host_tensor)
+        return self.tensors
+
+class HoldoutSplit:
+    """ Fixed split of the slots of a replay buffer into training and holdout slots.
+
+        Each slot is held out with probability holdout_frac, decided once from a fixed seed. A transition
+        therefore never moves between the two sets, and new transitions take over the role of the slot they
+        are stored in, so the holdout set refreshes along with the buffer. extend appends the slots filled since
+        the last call to the preallocated train and holdout arrays.
+    """
+    def __init__(self, max_size, holdout_frac, seed=0):
+        self.holdout_frac = holdout_frac
+        self.mask = np.random.default_rng(seed).random(max_size) < holdout_frac
+        self.train = np.zeros(max_size, dtype=np.int64)
+        self.holdout = np.zeros(max_size, dtype=np.int64)
+        self.num_train = 0
+        self.num_holdout = 0
+        self.size = 0
+
+    def extend(self, size):
+        if size <= self.size:
+            return
+        slots = np.arange(self.size, size)
+        mask = self.mask[self.size:size]
+        train, holdout = slots[~mask], slots[mask]
+        self.train[self.num_train:self.num_train + len(train)] = train
+        self.holdout[self.num_holdout:self.num_holdout + len(holdout)] = holdout
+        self.num_train += len(train)
+        self.num_holdout += len(holdout)
+        self.size = size
+
+class BufferStats:
+    """ Counters behind the stats of the buffers.
+
+        Inserts are counted with one addition each. Sample latencies go into a reservoir of num_samples timings
+        (Vitter's algorithm R), a uniform sample of every timing since the last reset in constant memory, so the
+        percentiles cost nothing until they are asked for. The reservoir draws from its own random.Random and
+        leaves the seeded numpy stream alone.
+    """
+    def __init__(self, num_samples=1024):
+        # a list, storing a float in it skips the conversion numpy does on every item assignment
+        self.latencies = [0.0] * num_samples
+        self.rng = random.Random(0)
+        self.reset()
+
+    def reset(self):
+        self.inserts = 0
+        self.samples = 0
+        self.start = time.perf_counter()
+
+    def record_sample(self, seconds):
+        if self.samples < len(self.latencies):
+            self.latencies[self.samples] = seconds
+        else:
+            # cheaper than randrange, the bias is far below what the percentiles can show
+            j = int(self.rng.random() * (self.samples + 1))
+            if j < len(self.latencies):
+                self.latencies[j] = seconds
+        self.samples += 1
+
+    def summary(self):
+        """ Returns the insert rate and latency percentiles since the last reset, the latencies are nan if
+            nothing was sampled """
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies[:min(self.samples, len(self.latencies))])
+        p50, p99 = np.percentile(latencies, (50, 99)) * 1e6 if len(latencies) > 0 else (np.nan, np.nan)
+        return {
+            "inserts": self.inserts,
+            "inserts_per_sec": self.inserts / elapsed if elapsed > 0 else 0.0,
+            "samples": self.samples,
+            "sample_p50_us": float(p50),
+            "sample_p99_us": float(p99)
+        }
+
+class MinibatchSampler:
+    """ Iterates over a batch of tensors in shuffled minibatches, e.g. the batch of GAEBuffer.get_buffer for
+        minibatch epochs of PPO.
+
+        The permutation and the minibatch tensors are preallocated on the batch's device the first time a batch
+        of that size is seen, then every epoch draws the permutation into the same tensor (torch.randperm with
+        out) and gathers each minibatch with index_select into the same outputs, so an epoch allocates nothing.
+        The tensors of a minibatch are overwritten by the next one. The last len % minibatch_size transitions
+        of each shuffled epoch are skipped, different ones every epoch.
+    """
+    def __init__(self, minibatch_size, device, seed=None):
+        self.minibatch_size = minibatch_size
+        self.device = device
+        # seeded from numpy by default so that runs seeded with np.random.seed stay reproducible
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed if seed is not None else np.random.randint(2 ** 31))
+        self.perm = None
+        self.minibatch = None
+
+    def epoch(self, batch):
+        """ Returns an iterator over one epoch of minibatches of batch
+
+        Args:
+            batch: tuple of (n, ...) tensors on the sampler's device
+
+        Returns:
+            iterator of tuples of (minibatch_size, ...) tensors
+        """
+        n = len(batch[0])
+        if self.minibatch_size > n:
+            raise ValueError(f"minibatch_size {self.minibatch_size} is larger than the batch of {n} transitions")
+        if self.perm is None or len(self.perm) != n:
+            self.perm = torch.zeros(n, dtype=torch.int64, device=self.device)
+            self.minibatch = tuple(
+                torch.zeros((self.minibatch_size,) + x.shape[1:], dtype=x.dtype, device=self.device) for x in batch
+            )
+        torch.randperm(n, generator=self.generator, device=self.device, out=self.perm)
+        return self._epoch(batch)
+
+    def _epoch(self, batch):
+        for start in range(0, len(self.perm) - self.minibatch_size + 1, self.minibatch_size):
+            indices = self.perm[start:start + self.minibatch_size]
+            for x, out in zip(batch, self.minibatch):
+                torch.index_select(x, 0, indices, out=out)
+            yield self.minibatch
+
+class TorchReplayBuffer(ReplayBuffer):
+    """ Replay Buffer whose storage is preallocated torch tensors on the training device.
+
+        Indices are drawn with a torch.Generator on the device and batches are gathered with index_select into
+        output tensors that are reused between calls, so sample_torch does no numpy -> torch conversion and no
+        allocation once warmed up. The tensors returned by sample_torch are overwritten by the next call.
+
+        Besides numpy dtypes, dtypes may contain "bfloat16". sample returns float32 arrays.
+    """
+    def __init__(self, max_size, state_dim, action_dim, device, seed=None, dtypes=None):
+        super(TorchReplayBuffer, self).__init__(max_size, state_dim, action_dim, device, dtypes=dtypes)
+        # seeded from numpy by default so that runs seeded with np.random.seed stay reproducible
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed if seed is not None else np.random.randint(2 ** 31))
+        self.batch_indices = None
+        self.batch = None
+        self.staging = None
+
+    def _allocate(self, name, shape, dtype):
+        if isinstance(dtype, str) and dtype == "bfloat16":
+            return torch.zeros(shape, dtype=torch.bfloat16, device=self.device)
+        return torch.zeros(shape, dtype=torch.from_numpy(np.zeros(0, dtype=dtype)).dtype, device=self.device)
+
+    def store(self, s, a, r, next_s, done):
+        self.states[self.index] = torch.as_tensor(s)
+        self.actions[self.index] = torch.as_tensor(a)
+        self.rewards[self.index] = float(r)
+        self.next_states[self.index] = torch.as_tensor(next_s)
+        self.dones[self.index] = float(done)
+        self._advance()
+
+    def _write_rows(self, field, start, rows):
+        field[start:start + len(rows)] = torch.as_tensor(rows, dtype=field.dtype).to(self.device)
+
+    def iter_epochs(self, batch_size, holdout_frac=0.0):
+        raise TypeError("epochs are only supported for numpy buffers")
+
+    def save(self, path):
+        raise TypeError("snapshots are only supported for numpy buffers")
+
+    def load(self, path):
+        raise TypeError("snapshots are only supported for numpy buffers")
+
+    def _sample_indices(self, num):
+        window = self._window()
+        indices = torch.randint(0, window, (num,), generator=self.generator, device=self.device)
+        if window < self.size:
+            indices = (self.index - 1 - indices) % self.max_size
+        return indices
+
+    def _gather(self, indices):
+        return tuple(torch.index_select(x, 0, indices) for x in self._fields())
+
+    def sample(self, num):
+        return tuple(x.float().cpu().numpy() for x in self._gather(self._sample_indices(num)))
+
+    def allocate_batch(self, num):
+        """ Returns None, sample_torch always fills the buffer's own output tensors """
+        return None
+
+    def sample_torch(self, num, out=None):
+        # out is accepted for compatibility with ReplayBuffer, the output tensors are always the buffer's own
+        start = time.perf_counter()
+        if self.batch_indices is None or len(self.batch_indices) != num:
+            self.batch_indices = torch.zeros(num, dtype=torch.int64, device=self.device)
+            self.batch = tuple(torch.zeros((num,) + x.shape[1:], device=self.device) for x in self._fields())
+            # fields not stored as float32 are gathered in their own dtype first, then cast into the batch
+            self.staging = tuple(
+                None if x.dtype == torch.float32 else torch.zeros((num,) + x.shape[1:], dtype=x.dtype, device=self.device)
+                for x in self._fields()
+            )
+
+        window = self._window()
+        torch.randint(0, window, (num,), generator=self.generator, device=self.device, out=self.batch_indices)
+        if window < self.size:
+            self.batch_indices.neg_().add_(self.index - 1 + self.max_size).remainder_(self.max_size)
+        for x, tensor, staging in zip(self._fields(), self.batch, self.staging):
+            if staging is None:
+                torch.index_select(x, 0, self.batch_indices, out=tensor)
+            else:
+                torch.index_select(x, 0, self.batch_indices, out=staging)
+                tensor.copy_(staging)
+        # kernels on a gpu run asynchronously, so this is the latency of launching them
+        self.metrics.record_sample(time.perf_counter() - start)
+        return self.batch
+
+class SumTree:
+    """ Array-backed binary sum-tree over a fixed number of leaves.
+
+        Node 1 is the root, node i has children 2i and 2i + 1, and leaf j is node capacity + j where capacity is
+        the number of leaves rounded up to a power of two. All operations take arrays of leaves and walk the
+        tree one level at a time, so a batch costs O(log n) numpy calls regardless of its size.
+    """
+    def __init__(self, num_leaves):
+        self.depth = max(int(num_leaves) - 1, 0).bit_length()
+        self.capacity = 1 << self.depth
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, leaves):
+        return self.tree[leaves + self.capacity]
+
+    def update(self, leaves, values):
+        """ Sets the values of the given leaves and recomputes the sums above them
+
+        Args:
+            leaves: (n,) int array, may contain duplicates (the last value wins)
+            values: (n,) array or scalar
+        """
+        nodes = np.asarray(leaves) + self.capacity
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            # parents are recomputed from their children, so duplicate nodes just write the same sum twice
+            nodes >>= 1
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def update_one(self, leaf, value):
+        """ Scalar version of update, cheaper for a single leaf """
+        node = leaf + self.capacity
+        self.tree[node] = value
+        for _ in range(self.depth):
+            node >>= 1
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def find(self, values):
+        """ Returns the leaves whose prefix-sum interval contains each of the given values
+
+        Args:
+            values: (n,) array of values in [0, total())
+
+        Returns:
+            (n,) int array of leaves
+        """
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            nodes <<= 1
+            left_sums = self.tree[nodes]
+            go_right = values >= left_sums
+            values -= left_sums * go_right
+            nodes += go_right
+        return nodes - self.capacity
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """ Replay Buffer which samples transitions with probability proportional to priority ** alpha
+        (Schaul et al., 2015). New transitions get the highest priority seen so far.
+
+        sample and sample_torch additionally return the importance-sampling weights (normalized by their max)
+        and the indices of the batch, which are passed back to update_priorities with the new TD errors.
+    """
+    def __init__(self, max_size, state_dim, action_dim, device, alpha=0.6, beta=0.4, eps=1e-6, path=None, dtypes=None):
+        super(PrioritizedReplayBuffer, self).__init__(max_size, state_dim, action_dim, device, path=path, dtypes=dtypes)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        self.tree = SumTree(self.max_size)
+
+        # priorities are not persisted, transitions of a reopened buffer start at the max priority
+        if self.size > 0:
+            self.tree.update(np.arange(self.size), self.max_priority ** self.alpha)
+
+    def store(self, s, a, r, next_s, done):
+        self.tree.update_one(self.index, self.max_priority ** self.alpha)
+        super(PrioritizedReplayBuffer, self).store(s, a, r, next_s, done)
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        n = min(len(states), self.max_size)
+        indices = (self.index + len(states) - n + np.arange(n)) % self.max_size
+        self.tree.update(indices, self.max_priority ** self.alpha)
+        super(PrioritizedReplayBuffer, self).store_batch(states, actions, rewards, next_states, dones)
+
+    def _sample_indices(self, num):
+        # stratified sampling, one value in each of num equal segments of the total priority
+        segment = self.tree.total() / num
+        values = (np.arange(num) + np.random.random_sample(num)) * segment
+        # guards against float round-off reaching the empty leaves past size
+        return np.minimum(self.tree.find(values), self.size - 1)
+
+    def _weights(self, indices):
+        probs = self.tree.get(indices) / self.tree.total()
+        weights = (self.size * probs) ** -self.beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def sample(self, num):
+        indices = self._sample_indices(num)
+        return self._gather(indices) + (self._weights(indices), indices)
+
+    def sample_torch(self, num):
+        start = time.perf_counter()
+        *batch, indices = self.sample(num)
+        batch = tuple(torch.as_tensor(x).to(self.device, torch.float32) for x in batch) + (indices,)
+        self.metrics.record_sample(time.perf_counter() - start)
+        return batch
+
+    def sample_many(self, num_batches, batch_size):
+        raise TypeError("priorities change after every batch, sample each batch with sample_torch")
+
+    def _arrays(self):
+        return dict(super(PrioritizedReplayBuffer, self)._arrays(), priorities=self.tree.tree)
+
+    def load(self, path):
+        # priorities are not part of snapshots, restored transitions start at the max priority
+        super(PrioritizedReplayBuffer, self).load(path)
+        self.tree = SumTree(self.max_size)
+        if self.size > 0:
+            self.tree.update(np.arange(self.size), self.max_priority ** self.alpha)
+
+    def update_priorities(self, indices, td_errors):
+        """ Sets the priorities of sampled transitions from their new TD errors
+
+        Args:
+            indices: (n,) int array returned by sample or sample_torch
+            td_errors: (n,) tensor or numpy array
+        """
+        if torch.is_tensor(td_errors):
+            td_errors = td_errors.detach().cpu().numpy()
+        priorities = np.abs(td_errors) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(indices, priorities ** self.alpha)
+
+class Prefetcher:
+    """ Samples batches from a replay buffer on a background thread, so that sampling overlaps with the update.
+
+        start(num_steps) samples the batches of one update round with buffer.sample_torch, up to num_batches of
+        them ahead, and get hands them over in order. stop has to be called before anything is stored again:
+        the thread only runs while the buffer is not written, so no batch is ever torn and the sample stats are
+        updated from one thread at a time.
+
+        Batches are filled in place into a ring of num_batches + 2 ReplayBatch, so a batch stays valid until the
+        next call to get. The indices come from the batches' own generators, which are seeded from numpy when
+        the Prefetcher is created, so seeded runs stay reproducible.
+
+        TorchReplayBuffer (which samples on its device already) and PrioritizedReplayBuffer (whose priorities
+        change after every batch) can not be prefetched.
+    """
+    def __init__(self, buffer, batch_size, num_batches=2):
+        if isinstance(buffer, (TorchReplayBuffer, PrioritizedReplayBuffer)):
+            raise TypeError(f"{type(buffer).__name__} can not be prefetched")
+        self.buffer = buffer
+        self.batch_size = batch_size
+        self.batches = [buffer.allocate_batch(batch_size) for _ in range(num_batches + 2)]
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, num_steps):
+        """ Starts sampling the num_steps batches of an update round in the background """
+        if self.thread is not None:
+            raise ValueError("the prefetcher is running already, stop it first")
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, args=(num_steps,), daemon=True)
+        self.thread.start()
+
+    def _run(self, num_steps):
+        for i in range(num_steps):
+            batch = self.buffer.sample_torch(self.batch_size, out=self.batches[i % len(self.batches)])
+            # wakes up regularly to notice stop while the queue is full
+            while not self.stopped.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self.stopped.is_set():
+                return
+
+    def get(self):
+        """ Returns the next batch, same as buffer.sample_torch(batch_size) """
+        return self.queue.get()
+
+    def stop(self):
+        """ Stops the background thread and drops the batches that were not taken """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
 class GAEBuffer:
-    def __init__(self, batch_size, lam, discount, state_dim, action_dim, agent, device):
+    """ On-policy buffer of one batch of steps, which computes the GAE advantages and rewards-to-go of each
+        trajectory as it ends.
+
+        store_numpy writes the steps into preallocated host arrays (pinned memory when cuda is available) and
+        the rows stored since the last sync are copied to the device tensors in one copy per field when
+        calc_trajectory or get_buffer runs. On the CPU the device tensors are views of the host arrays, so there
+        is nothing to copy.
+
+        With deferred, calc_trajectory only records where the trajectory ends and its final value. get_buffer
+        then evaluates the whole batch in one forward pass under no_grad and computes the GAE and rewards-to-go
+        of all trajectories with one scan (see discounted_cumsum_scan), instead of one forward pass with an
+        autograd graph per trajectory. The agent must not change between the stores and get_buffer, as is the
+        case in an on-policy update.
+
+        store_numpy can also take the log prob and value computed when the action was sampled (see
+        PPOAgent.sample_action_numpy). Trajectories whose steps all have them skip agent.evaluate entirely.
+    """
+    def __init__(self, batch_size, lam, discount, state_dim, action_dim, agent, device, deferred=False):
         self.batch_size = batch_size
         self.lam = lam
         self.discount = discount
+        self.deferred = deferred
 
         self.agent = agent
         self.device = device
-        
-        self.states = torch.zeros((batch_size, state_dim)).to(self.device)
-        self.actions = torch.zeros((batch_size, action_dim)).to(self.device)
-        self.rewards = torch.zeros(batch_size).to(self.device)
+
+        # host staging of the fields written by store_numpy, rows [0, synced) are on the device
+        pin = torch.cuda.is_available()
+        shapes = ((batch_size, state_dim), (batch_size, action_dim), (batch_size,), (batch_size,), (batch_size,))
+        self.host_tensors = tuple(torch.zeros(shape, pin_memory=pin) for shape in shapes)
+        (self.host_states, self.host_actions, self.host_rewards,
+         self.host_log_probs, self.host_values) = (x.numpy() for x in self.host_tensors)
+        self.staged = torch.device(device).type != "cpu"
+        if self.staged:
+            staged = tuple(torch.zeros(x.shape, device=self.device) for x in self.host_tensors)
+        else:
+            staged = self.host_tensors
+        self.states, self.actions, self.rewards, self.log_probs, self.values = staged
         self.advs = torch.zeros(batch_size).to(self.device)
-        self.log_probs = torch.zeros(batch_size).to(self.device)
+        # whether the log prob and value of a step were stored with it
+        self.evaluated = np.zeros(batch_size, dtype=np.bool_)
+
+        # last step and final value of each trajectory, for deferred
+        self.ends = np.zeros(batch_size, dtype=np.bool_)
+        self.final_values = np.zeros(batch_size, dtype=np.float32)
 
         self.num = 0
         self.trajectory_start = 0
+        self.synced = 0
+        self.metrics = BufferStats()
 
-    def store_numpy(self, s, a, r):
-        self.store(torch.tensor(s), torch.tensor(a), r)
+    def store_numpy(self, s, a, r, log_prob=None, value=None):
+        assert not self.is_full(), "Tried to store but buffer is full."
+        self.host_states[self.num] = s
+        self.host_actions[self.num] = a
+        self.host_rewards[self.num] = r
+        if log_prob is not None and value is not None:
+            self.host_log_probs[self.num] = log_prob
+            self.host_values[self.num] = value
+            self.evaluated[self.num] = True
+        self.num += 1
+        self.metrics.inserts += 1
+
+    def _sync(self):
+        """ Copies the rows staged by store_numpy since the last sync to the device """
+        if self.staged and self.num > self.synced:
+            rows = slice(self.synced, self.num)
+            for field, host in zip((self.states, self.actions, self.rewards, self.log_probs, self.values),
+                                   self.host_tensors):
+                field[rows].copy_(host[rows])
+        self.synced = self.num
 
     def store(self, s, a, r):
         assert not self.is_full(), "Tried to store but buffer is full."
+        self._sync()
+        self.synced += 1
         self.states[self.num] = s
         self.actions[self.num] = a
         self.rewards[self.num] = r
         self.num += 1
+        self.metrics.inserts += 1
+
+    def store_batch(self, states, actions, rewards, dones=None):
+        """ Stores n steps with one copy per field. rewards[i] is the reward for taking actions[i] in states[i].
+
+        Args:
+            states: (n, state_dim) array or tensor
+            actions: (n, action_dim) array or tensor
+            rewards: (n,) array or tensor
+            dones: optional (n,) array, the trajectory is closed with a final value of 0 after every true entry.
+                A trajectory still running at the end of the batch is closed by the caller with calc_trajectory,
+                as with store.
+        """
+        n = len(states)
+        assert self.num + n <= self.batch_size, "Tried to store but buffer is full."
+        self._sync()
+        start = self.num
+        for field, x in ((self.states, states), (self.actions, actions), (self.rewards, rewards)):
+            field[start:start + n] = torch.as_tensor(x, dtype=torch.float32).to(self.device)
+        self.synced = start + n
+
+        if dones is not None:
+            for end in np.flatnonzero(np.asarray(dones)) + 1:
+                self.num = start + end
+                self.calc_trajectory(0.0)
+        self.num = start + n
+        self.metrics.inserts += n
 
     def is_full(self):
         return self.num == self.batch_size
@@ -116,17 +1438,27 @@ class GAEBuffer:
             is_terminal: if s is not a terminal state (e.g. max_ep_len or batch_size reached), then use the 
                 agent's value function to estimate the returns
         """
+        if self.deferred:
+            self.ends[self.num - 1] = True
+            self.final_values[self.num - 1] = final_val
+            self.trajectory_start = self.num
+            return
+
+        self._sync()
         trajectory = slice(self.trajectory_start, self.num)
 
-        # calculate the state-values and log-probs of this trajectory
-        values, log_probs, _ = self.agent.evaluate(self.states[trajectory], self.actions[trajectory])
-        if values.dim() == 0:
-            values = values.reshape(1)
-        if log_probs.dim() == 0:
-            log_probs = log_probs.reshape(1)
+        # calculate the state-values and log-probs of this trajectory, unless they were stored with the steps
+        if self.evaluated[trajectory].all():
+            values = self.values[trajectory]
+        else:
+            values, log_probs, _ = self.agent.evaluate(self.states[trajectory], self.actions[trajectory])
+            if values.dim() == 0:
+                values = values.reshape(1)
+            if log_probs.dim() == 0:
+                log_probs = log_probs.reshape(1)
+            self.log_probs[trajectory] = log_probs.detach()
         values = torch.cat((values, torch.Tensor([final_val]).to(self.device)))
         rewards = torch.cat((self.rewards[trajectory], torch.Tensor([final_val]).to(self.device)))
-        self.log_probs[trajectory] = log_probs
 
         # GAE calculations for actor update
         deltas = rewards[:-1] + self.discount * values[1:] - values[:-1]
@@ -137,6 +1469,28 @@ class GAEBuffer:
 
         # start new trajectory
         self.trajectory_start = self.num
+
+    def _calc_deferred(self):
+        """ Calculates the GAE and rewards-to-go of every trajectory recorded by a deferred calc_trajectory """
+        assert self.trajectory_start == self.num, "Tried to get buffer before the last trajectory was calculated"
+        if self.evaluated.all():
+            values = self.values
+        else:
+            with torch.no_grad():
+                values, log_probs, _ = self.agent.evaluate(self.states, self.actions)
+            self.log_probs[:] = log_probs.reshape(-1)
+            values = values.reshape(-1)
+
+        # the value after the last step of a trajectory is its final value, and nothing is carried across
+        ends = torch.from_numpy(self.ends).to(self.device)
+        final_values = torch.from_numpy(self.final_values).to(self.device)
+        next_values = torch.where(ends, final_values, torch.cat((values[1:], values[-1:])))
+        discounts = torch.where(ends, torch.zeros_like(values), torch.full_like(values, self.discount))
+
+        deltas = self.rewards + self.discount * next_values - values
+        self.advs[:] = discounted_cumsum_scan(deltas, discounts * self.lam)
+        self.rewards += self.discount * torch.where(ends, final_values, torch.zeros_like(values))
+        self.rewards[:] = discounted_cumsum_scan(self.rewards, discounts)
     
     def batch_normalize_advs(self, eps=1e-8):
         assert self.is_full(), "Tried to batch normalize before buffer is full"
@@ -145,10 +1499,138 @@ class GAEBuffer:
 
     def get_buffer(self):
         assert self.is_full(), "Tried to get buffer before buffer is full"
+        start = time.perf_counter()
+        self._sync()
+        if self.deferred:
+            self._calc_deferred()
         self.batch_normalize_advs()
         self.clear()
-        return self.states.detach(), self.actions.detach(), self.rewards.detach(), self.advs.detach(), self.log_probs.detach()
+        batch = self.states.detach(), self.actions.detach(), self.rewards.detach(), self.advs.detach(), self.log_probs.detach()
+        self.metrics.record_sample(time.perf_counter() - start)
+        return batch
+
+    def _arrays(self):
+        """ Returns the preallocated arrays of the buffer by name, for stats """
+        arrays = {"states": self.states, "actions": self.actions, "rewards": self.rewards, "advs": self.advs,
+                  "log_probs": self.log_probs, "values": self.values}
+        if self.staged:
+            names = ("host_states", "host_actions", "host_rewards", "host_log_probs", "host_values")
+            arrays.update(zip(names, self.host_tensors))
+        return arrays
+
+    def stats(self, reset=False):
+        """ Returns the same statistics as ReplayBuffer.stats, with the latency of get_buffer as the sample
+            latency and the number of steps stored in the current batch as size """
+        nbytes = {name: _nbytes(x) for name, x in self._arrays().items()}
+        stats = {
+            "bytes": nbytes,
+            "total_bytes": sum(nbytes.values()),
+            "size": self.num,
+            "max_size": self.batch_size,
+            "fill_ratio": self.num / self.batch_size
+        }
+        stats.update(self.metrics.summary())
+        if reset:
+            self.metrics.reset()
+        return stats
 
     def clear(self):
         self.num = 0
         self.trajectory_start = 0
+        self.synced = 0
+        self.ends[:] = False
+        self.evaluated[:] = False
+
+class VecGAEBuffer(GAEBuffer):
+    """ GAEBuffer for num_envs environments stepped together, e.g. a vectorized environment.
+
+        The storage is laid out as (num_steps, num_envs): row t * num_envs + i of the flat tensors is step t of
+        environment i, and every store_numpy call stores one step of all environments. Episodes end at the steps
+        flagged done, the environments are expected to reset themselves. Once num_steps steps are stored,
+        calc_trajectory evaluates the whole rollout in one call and computes the GAE advantages and rewards-to-go
+        of all environments with one scan over the steps (see discounted_cumsum_scan), where done masks cut the
+        trajectories, so there is no Python work per trajectory or per step. get_buffer returns the flat
+        (num_steps * num_envs, ...) batch, same as GAEBuffer.
+
+        A step that was truncated (e.g. at max_ep_len) rather than terminal is stored as done, with discount
+        times the value of the state it was cut at added to its reward.
+    """
+    def __init__(self, num_steps, num_envs, lam, discount, state_dim, action_dim, agent, device):
+        super(VecGAEBuffer, self).__init__(num_steps * num_envs, lam, discount, state_dim, action_dim, agent, device)
+        self.num_steps = num_steps
+        self.num_envs = num_envs
+        self.host_dones = np.zeros(num_steps * num_envs, dtype=np.float32)
+
+    def store_numpy(self, states, actions, rewards, dones, log_probs=None, values=None):
+        """ Stores one step of every environment
+
+        Args:
+            states: (num_envs, state_dim) array
+            actions: (num_envs, action_dim) array
+            rewards: (num_envs,) array, rewards[i] is the reward for taking actions[i] in states[i]
+            dones: (num_envs,) array, whether the episode of each environment ended with this step
+            log_probs: optional (num_envs,) array of the log probs of the actions when they were sampled
+            values: optional (num_envs,) array of the values of the states
+        """
+        assert not self.is_full(), "Tried to store but buffer is full."
+        rows = slice(self.num, self.num + self.num_envs)
+        self.host_states[rows] = states
+        self.host_actions[rows] = actions
+        self.host_rewards[rows] = rewards
+        self.host_dones[rows] = dones
+        if log_probs is not None and values is not None:
+            self.host_log_probs[rows] = log_probs
+            self.host_values[rows] = values
+            self.evaluated[rows] = True
+        self.num += self.num_envs
+        self.metrics.inserts += self.num_envs
+
+    def store(self, states, actions, rewards, dones):
+        """ Same as store_numpy, with the states, actions and rewards as tensors """
+        assert not self.is_full(), "Tried to store but buffer is full."
+        self._sync()
+        rows = slice(self.num, self.num + self.num_envs)
+        self.states[rows] = states
+        self.actions[rows] = actions
+        self.rewards[rows] = rewards
+        self.host_dones[rows] = np.asarray(dones)
+        self.num += self.num_envs
+        self.synced = self.num
+        self.metrics.inserts += self.num_envs
+
+    def store_batch(self, states, actions, rewards, dones=None):
+        raise TypeError("the steps of all environments are stored together with store_numpy or store")
+
+    def _arrays(self):
+        return dict(super(VecGAEBuffer, self)._arrays(), dones=self.host_dones)
+
+    def calc_trajectory(self, final_values):
+        """ Once the buffer is full, calculates the GAE and rewards-to-go of every environment
+
+        Args:
+            final_values: (num_envs,) array or tensor, the values of the states after the last step, which
+                bootstrap the episodes still running. Ignored for environments whose last step was done.
+        """
+        assert self.is_full(), "Tried to calculate the advantages before buffer is full"
+        self._sync()
+        shape = (self.num_steps, self.num_envs)
+
+        # one evaluation of the whole rollout, none if the steps were stored with their values
+        if self.evaluated.all():
+            values = self.values.view(shape)
+        else:
+            with torch.no_grad():
+                values, log_probs, _ = self.agent.evaluate(self.states, self.actions)
+            self.log_probs[:] = log_probs.reshape(-1)
+            values = values.reshape(shape)
+        final_values = torch.as_tensor(final_values, dtype=torch.float32).to(self.device).reshape(1, self.num_envs)
+
+        # discounts that are 0 across the end of an episode
+        discounts = (1.0 - torch.from_numpy(self.host_dones).to(self.device).reshape(shape)) * self.discount
+        rewards = self.rewards.view(shape)
+        deltas = rewards + discounts * torch.cat((values[1:], final_values)) - values
+
+        # one scan over the steps for all environments at once, the rewards-to-go bootstrap from the final values
+        self.advs.view(shape)[:] = discounted_cumsum_scan(deltas, discounts * self.lam)
+        rewards[-1] += discounts[-1] * final_values[0]
+        rewards[:] = discounted_cumsum_scan(rewards, discounts)
@@ -0,0 +1,182 @@
+import os
+import json
+
+import torch
+import numpy as np
+
+from core.buffers import DEFAULT_DTYPES
+
+# fields of a transition, in the order of ReplayBuffer.store
+FIELDS = ("states", "actions", "rewards", "next_states", "dones")
+
+class DatasetWriter:
+    """ Writes logged transitions to an offline dataset on disk.
+
+        A dataset is a directory of shards, each one .npy file per field named {shard:05d}_{field}.npy, and a
+        manifest.json with the shapes, dtypes and sizes of the shards. Transitions are collected into one
+        preallocated shard of shard_size transitions at a time, so datasets larger than RAM can be written.
+        The manifest is only written by close, a dataset without one is incomplete.
+    """
+    def __init__(self, path, state_dim, action_dim, shard_size=100000, dtypes=None):
+        self.path = path
+        self.shard_size = int(shard_size)
+        os.makedirs(path, exist_ok=True)
+
+        dtypes = dict(DEFAULT_DTYPES, **(dtypes or {}))
+        shapes = {
+            "states": (state_dim,),
+            "actions": (action_dim,),
+            "rewards": (),
+            "next_states": (state_dim,),
+            "dones": ()
+        }
+        self.fields = {name: (shapes[name], np.dtype(dtypes[name])) for name in FIELDS}
+        self.shard = tuple(np.zeros((self.shard_size,) + shape, dtype=dtype) for shape, dtype in self.fields.values())
+        self.index = 0
+        self.shard_sizes = []
+
+    def store(self, s, a, r, next_s, done):
+        for field, x in zip(self.shard, (s, a, r, next_s, done)):
+            field[self.index] = x
+        self.index += 1
+        if self.index == self.shard_size:
+            self._write_shard()
+
+    def store_batch(self, states, actions, rewards, next_states, dones):
+        """ Stores n transitions, same as calling store on each of them in order
+
+        Args:
+            states: (n, state_dim) array
+            actions: (n, action_dim) array
+            rewards: (n,) array
+            next_states: (n, state_dim) array
+            dones: (n,) array
+        """
+        batch = (states, actions, rewards, next_states, dones)
+        start = 0
+        while start < len(states):
+            n = min(len(states) - start, self.shard_size - self.index)
+            for field, x in zip(self.shard, batch):
+                field[self.index:self.index + n] = x[start:start + n]
+            self.index += n
+            start += n
+            if self.index == self.shard_size:
+                self._write_shard()
+
+    def _write_shard(self):
+        shard = len(self.shard_sizes)
+        for name, field in zip(FIELDS, self.shard):
+            np.save(os.path.join(self.path, f"{shard:05d}_{name}.npy"), field[:self.index])
+        self.shard_sizes.append(self.index)
+        self.index = 0
+
+    def close(self):
+        """ Writes the last, partial shard and the manifest """
+        if self.index > 0:
+            self._write_shard()
+        manifest = {
+            "fields": {name: {"shape": list(shape), "dtype": dtype.str} for name, (shape, dtype) in self.fields.items()},
+            "shards": self.shard_sizes,
+            "size": sum(self.shard_sizes)
+        }
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+class ShardedDataset:
+    """ Offline dataset written by DatasetWriter, read from memory-mapped shards.
+
+        Nothing is read up front: shards are memory-mapped when first used, so only the pages that are used
+        get loaded (and the OS page cache can drop them again). fill streams the dataset into a ReplayBuffer,
+        iter_batches iterates minibatches straight from the shards.
+    """
+    def __init__(self, path, device):
+        self.path = path
+        self.device = device
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.shard_sizes = manifest["shards"]
+        self.size = manifest["size"]
+        self.shards = {}
+
+    def _shard(self, shard):
+        """ Returns the fields of a shard as memory-mapped arrays """
+        if shard not in self.shards:
+            self.shards[shard] = tuple(
+                np.load(os.path.join(self.path, f"{shard:05d}_{name}.npy"), mmap_mode="r") for name in FIELDS
+            )
+        return self.shards[shard]
+
+    def fill(self, buffer, chunk_size=100000, shuffle=False):
+        """ Stores every transition of the dataset in buffer with store_batch
+
+        If the dataset is larger than the buffer, only the last buffer.max_size transitions stay in it, so
+        shuffle the dataset to keep a random subset of it instead of its last shards.
+
+        Args:
+            buffer: ReplayBuffer (or a subclass) to fill
+            chunk_size: number of transitions copied per store_batch call
+            shuffle: whether to store the transitions in random order
+        """
+        if shuffle:
+            for batch in self.iter_batches(chunk_size, shuffle=True, as_tensors=False):
+                buffer.store_batch(*batch)
+            return
+
+        for shard in range(len(self.shard_sizes)):
+            fields = self._shard(shard)
+            for start in range(0, self.shard_sizes[shard], chunk_size):
+                buffer.store_batch(*(x[start:start + chunk_size] for x in fields))
+
+    def iter_batches(self, batch_size, shuffle=True, shuffle_shards=4, seed=None, as_tensors=True):
+        """ Iterates over the dataset in minibatches, once
+
+        With shuffle, the shards are visited in random order, shuffle_shards of them at a time, and the
+        transitions of those shards are drawn in random order. More shuffle_shards mixes the data better but
+        spreads the reads over more files. The last batch of each group of shards may be smaller.
+
+        Args:
+            batch_size: number of transitions in a batch
+            shuffle: whether to shuffle the transitions
+            shuffle_shards: number of shards shuffled together
+            seed: seed of the shuffling, drawn from np.random by default
+            as_tensors: whether to yield float32 tensors on the device instead of numpy arrays
+
+        Returns:
+            iterator of tuples of (batch_size, ...) states, actions, rewards, next_states and dones
+        """
+        # seeded from numpy by default so that runs seeded with np.random.seed stay reproducible
+        rng = np.random.default_rng(seed if seed is not None else np.random.randint(2 ** 31))
+        num_shards = len(self.shard_sizes)
+        order = rng.permutation(num_shards) if shuffle else np.arange(num_shards)
+        group_size = shuffle_shards if shuffle else 1
+
+        for g in range(0, num_shards, group_size):
+            group = order[g:g + group_size]
+            offsets = np.cumsum([0] + [self.shard_sizes[shard] for shard in group])
+            positions = rng.permutation(offsets[-1]) if shuffle else np.arange(offsets[-1])
+
+            for start in range(0, len(positions), batch_size):
+                batch_positions = positions[start:start + batch_size]
+                if len(group) == 1:
+                    shard_of = np.zeros(len(batch_positions), dtype=np.int64)
+                else:
+                    shard_of = np.searchsorted(offsets, batch_positions, side="right") - 1
+
+                batch = None
+                for j, shard in enumerate(group):
+                    rows = batch_positions[shard_of == j] - offsets[j]
+                    if len(rows) == 0:
+                        continue
+                    # sorted rows read the memory-mapped shard front to back, the order within a batch is arbitrary
+                    rows.sort()
+                    fields = self._shard(shard)
+                    if batch is None:
+                        batch = tuple(np.empty((len(batch_positions),) + x.shape[1:], dtype=x.dtype) for x in fields)
+                    mask = shard_of == j
+                    for x, out in zip(fields, batch):
+                        out[mask] = np.take(x, rows, axis=0)
+
+                if as_tensors:
+                    yield tuple(torch.as_tensor(x).to(self.device, torch.float32) for x in batch)
+                else:
+                    yield batch
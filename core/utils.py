@@ -2,14 +2,107 @@ import torch
 import numpy as np 
 
 import time
+import functools
+import tracemalloc
+
+# length of the chunks scanned with one matrix product in discounted_cumsum_torch
+CUMSUM_CHUNK = 64
+
+@functools.lru_cache(maxsize=64)
+def _discount_matrix(discount, size, device, dtype):
+    """ Returns the (size, size) upper triangular matrix with discount ** (j - i) at [i, j], j >= i """
+    steps = torch.arange(size, device=device)
+    exponents = steps[None, :] - steps[:, None]
+    powers = torch.pow(torch.tensor(discount, dtype=torch.float64, device=device), exponents.clamp(min=0))
+    return torch.where(exponents >= 0, powers, torch.zeros_like(powers)).to(dtype)
 
 def discounted_cumsum_torch(x, discount):
-    ret = torch.zeros_like(x)
-    ret[-1] = x[-1]
-    for t in range(len(x) - 2, -1, -1):
-        ret[t] = x[t] + discount * ret[t + 1]
+    """ Returns ret with ret[t] = sum_k discount ** k * x[t + k], i.e. ret[t] = x[t] + discount * ret[t + 1]
+
+    Instead of a Python loop over the steps, x is cut into chunks of CUMSUM_CHUNK steps which are all scanned at
+    once with one matrix product. The sum at the start of each chunk is then carried back from the later chunks
+    by the same scan over one value per chunk with discount ** CUMSUM_CHUNK, so a trajectory of n steps takes
+    O(log n) tensor operations on its device. Only powers of discount <= 1 are formed (no division by them),
+    so the result matches the loop up to float rounding.
+
+    Args:
+        x: (n, ...) tensor, scanned along the first dimension
+        discount: discount factor
+
+    Returns:
+        (n, ...) tensor
+    """
+    n = len(x)
+    if n == 0:
+        return torch.zeros_like(x)
+    size = CUMSUM_CHUNK
+    num_chunks = -(-n // size)
+
+    # zero padding at the end adds nothing to the sums before it
+    padded = torch.zeros((num_chunks * size,) + tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
+    padded[:n] = x
+    chunks = padded.reshape(num_chunks, size, -1).transpose(1, 2)
+
+    # sums within each chunk, (num_chunks, size, k). With the steps last this is one (num_chunks * k, size) by
+    # (size, size) matrix product
+    ret = torch.matmul(chunks, _discount_matrix(float(discount), size, x.device, x.dtype).T).transpose(1, 2)
+    if num_chunks > 1:
+        # full sums at the chunk starts, each one carries discount ** (size - i) into step i of the chunk before
+        starts = discounted_cumsum_torch(ret[:, 0], discount ** size)
+        tail = _discount_matrix(float(discount), size + 1, x.device, x.dtype)[:size, size]
+        ret[:-1] += tail[None, :, None] * starts[1:, None]
+    return ret.reshape(padded.shape)[:n]
+
+def discounted_cumsum_scan(x, discounts):
+    """ Returns ret with ret[t] = x[t] + discounts[t] * ret[t + 1], a discounted cumsum whose discount changes
+        every step, e.g. 0 at the end of an episode to cut trajectories apart
+
+    Computed along the first dimension with a log-depth (Hillis-Steele) scan: after the round with stride s,
+    ret[t] holds the discounted sum of x[t:t + 2s] and coefs[t] the product of discounts[t:t + 2s], so n steps
+    take O(log n) rounds of a few tensor operations. Only products of the discounts are formed, so the result
+    matches the step-by-step loop up to float rounding as long as the discounts are at most 1.
+
+    Args:
+        x: (n, ...) tensor
+        discounts: (n, ...) tensor, same shape as x
+
+    Returns:
+        (n, ...) tensor
+    """
+    ret = x.clone()
+    coefs = discounts.clone()
+    shift = 1
+    while shift < len(x):
+        # the right hand sides are computed before the overlapping slices are written
+        ret[:-shift] = ret[:-shift] + coefs[:-shift] * ret[shift:]
+        coefs[:-shift] = coefs[:-shift] * coefs[shift:]
+        shift *= 2
     return ret
 
+def allocation_profile(fn, steps=100, warmup=10):
+    """ Measures the heap allocations of fn with tracemalloc, after warmup calls
+
+    Numpy array buffers and Python objects are traced. Torch tensor storage is not, so this only shows
+    allocations made through numpy and Python.
+
+    Returns:
+        peak bytes allocated within a single call (and possibly freed again), max over steps,
+        bytes still allocated after all steps
+    """
+    for _ in range(warmup):
+        fn()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    peak = 0
+    for _ in range(steps):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    retained = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return peak, retained
+
 def test_agent(agent, env, n_tests, delay=1.0, bullet=True):
     agent.action_noise = 0.0
     for test in range(n_tests):
@@ -12,6 +12,12 @@ from core.models import DeterministicDeltaModel
 from core.models import RandomShootingMPCPolicy
 
 from core.buffers import ReplayBuffer
+from core.buffers import CompactReplayBuffer
+from core.buffers import SequenceReplayBuffer
+from core.buffers import snapshot_exists
+from core.buffers import format_stats
+
+from core.datasets import ShardedDataset
 
 from core.utils import test_agent
 
@@ -72,28 +78,104 @@ def train(agent, env, params):
     start_steps  = params["start_steps"]
     update_steps = params["update_steps"]
     sample_size  = params["sample_size"]
+    buffer_path  = params["buffer_path"]
+    compact      = params["compact_buffer"]
+    dtypes       = {"states": params["obs_dtype"], "next_states": params["obs_dtype"], "dones": params["done_dtype"]}
+    rollout      = params["model_rollout"]
+    snapshot     = params["buffer_snapshot"]
+    dataset      = params["dataset"]
+    model_epochs = params["model_epochs"]
+    holdout_frac = params["holdout_frac"]
+    patience     = params["patience"]
+    buffer_stats = params["buffer_stats"]
+
+    # epochs train on one-step transitions only
+    if model_epochs > 0 and rollout > 1:
+        raise ValueError("model_epochs can not be combined with model_rollout > 1")
+    if snapshot is not None and buffer_path is not None:
+        raise ValueError("a buffer at buffer_path is reopened from its own files after a restart, "
+                         "buffer_snapshot can not be combined with buffer_path")
 
     model_optimizer = torch.optim.Adam(agent.model.parameters(), lr=lr)
-    buffer = ReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device)
+    if rollout > 1:
+        buffer = SequenceReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, path=buffer_path,
+                                      dtypes=dtypes)
+    elif compact:
+        buffer = CompactReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, path=buffer_path,
+                                     dtypes=dtypes)
+    else:
+        buffer = ReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, path=buffer_path, dtypes=dtypes)
+
+    # resume from the last snapshot of the buffer after a preemption, the warmup below skips what it holds
+    if snapshot is not None and snapshot_exists(snapshot):
+        buffer.load(snapshot)
+    elif dataset is not None:
+        # pretrain on logged transitions. A dataset larger than the buffer is stored in random order, so that a
+        # random subset of it stays instead of its end (this loses the order CompactReplayBuffer and the
+        # sequences of SequenceReplayBuffer rely on).
+        data = ShardedDataset(dataset, device)
+        data.fill(buffer, shuffle=data.size > buffer.max_size)
+
+    def one_step_loss(states, actions, next_states):
+        state_changes = next_states - states
+        predicted_state_changes = agent.evaluate_model(states, actions)
+        squared_norms = torch.sum((state_changes - predicted_state_changes) ** 2, 1)
+        return torch.mean(squared_norms)
+
+    # one iterator of batches per epoch (of one-step transitions), it picks up the transitions stored between rounds
+    epochs = buffer.iter_epochs(sample_size, holdout_frac) if model_epochs > 0 else None
+
+    def update_epochs():
+        """ Trains the model by epochs until the holdout loss has not improved for patience epochs """
+        best_loss, bad_epochs = float("inf"), 0
+        holdout = buffer.holdout()
+        for epoch in range(model_epochs):
+            for states, actions, _, next_states, _ in next(epochs):
+                model_loss = one_step_loss(states, actions, next_states)
+                model_optimizer.zero_grad()
+                model_loss.backward()
+                model_optimizer.step()
+
+            if len(holdout[0]) == 0:
+                continue
+            with torch.no_grad():
+                holdout_loss = one_step_loss(holdout[0], holdout[1], holdout[3]).item()
+            if holdout_loss < best_loss:
+                best_loss, bad_epochs = holdout_loss, 0
+            else:
+                bad_epochs += 1
+                if bad_epochs >= patience:
+                    break
+        print(f"model epochs: {epoch + 1}, \t holdout loss: {best_loss}")
 
     def update():
-        for _ in range(update_steps):
-            states, actions, _, next_states, _ = buffer.sample_torch(sample_size)
+        if epochs is not None:
+            update_epochs()
+            return
 
-            state_changes = next_states - states
-            predicted_state_changes = agent.evaluate_model(states, actions)
-            squared_norms = torch.sum((state_changes - predicted_state_changes) ** 2, 1)
-            model_loss = torch.mean(squared_norms)
+        for _ in range(update_steps):
+            if rollout > 1:
+                # the model is rolled out on its own predictions for rollout steps of each sampled sequence
+                states, actions, _, next_states, _ = buffer.sample_sequences(sample_size, rollout)
+                predicted_states = states[:, 0]
+                squared_norms = 0
+                for k in range(rollout):
+                    predicted_states = predicted_states + agent.evaluate_model(predicted_states, actions[:, k])
+                    squared_norms = squared_norms + torch.sum((next_states[:, k] - predicted_states) ** 2, 1)
+                model_loss = torch.mean(squared_norms) / rollout
+            else:
+                states, actions, _, next_states, _ = buffer.sample_torch(sample_size)
+                model_loss = one_step_loss(states, actions, next_states)
             
             model_optimizer.zero_grad()
             model_loss.backward()
             model_optimizer.step()
 
-    # Random exploration at the beginning for start_steps
+    # Random exploration at the beginning for start_steps, minus the steps already in a reopened buffer
     print(f"Start steps: {int(start_steps)}")
     s, r, done = env.reset(), 0, False
     ep_len = 0
-    for _ in range(int(start_steps)):
+    for _ in range(max(int(start_steps) - buffer.size, 0)):
         a = env.action_space.sample()
         new_s, r, done, _ = env.step(a)
         buffer.store(s, a, r, new_s, done)
@@ -146,12 +228,18 @@ def train(agent, env, params):
 
         end = time.time()
         print(f"{end - start}s, \t episode: {ep}, \t return: {np.mean(ep_returns)}, \t episode length: {np.mean(ep_lens)}")
+        if buffer_stats:
+            print(format_stats(buffer.stats(reset=True)))
         
         if ep - last_save >= save_freq:
             torch.save(agent.state_dict(), f"{save_path}/ep_{ep}.pth")
+            if snapshot is not None:
+                buffer.save(snapshot)
             last_save = ep
         
     torch.save(agent.state_dict(), f"{save_path}/ep_{ep}.pth")
+    if snapshot is not None:
+        buffer.save(snapshot)
 
 if __name__ == '__main__':
     import argparse, os
@@ -174,7 +262,18 @@ if __name__ == '__main__':
     parser.add_argument("--batch_size", "-bs", type=int, default=8000)
     parser.add_argument("--learning_rate", "-lr", type=float, default=0.001)
     parser.add_argument("--buffer_size", type=int, default=100000)
+    parser.add_argument("--buffer_path", type=str, default=None)
+    parser.add_argument("--buffer_snapshot", type=str, default=None)
+    parser.add_argument("--dataset", type=str, default=None)
+    parser.add_argument("--buffer_stats", action="store_true")
+    parser.add_argument("--compact_buffer", action="store_true")
+    parser.add_argument("--obs_dtype", type=str, default="float32", choices=["float32", "float16"])
+    parser.add_argument("--done_dtype", type=str, default="float32", choices=["float32", "uint8"])
     parser.add_argument("--update_steps", type=int, default=80)
+    parser.add_argument("--model_rollout", type=int, default=1)
+    parser.add_argument("--model_epochs", type=int, default=0)
+    parser.add_argument("--holdout_frac", type=float, default=0.1)
+    parser.add_argument("--patience", type=int, default=2)
     parser.add_argument("--sample_size", type=int, default=512)
 
     parser.add_argument("--mpc_horizon", type=int, default=10)
@@ -7,6 +7,8 @@ import pybullet_envs
 import time
 
 from core.buffers import GAEBuffer
+from core.buffers import MinibatchSampler
+from core.buffers import format_stats
 
 from core.agents import Agent
 from core.agents import GaussianPolicy
@@ -55,60 +57,109 @@ class PPOAgent(Agent):
         values = torch.squeeze(self.vf(states))
         return values
 
-    def sample_action(self, state):
+    def sample_action(self, state, return_info=False):
         """ Returns an action based on the current policy given state
 
         Args:
             state: (state_dim,) tensor
+            return_info: whether to also return the log prob of the action and the value of state, from the
+                same forward pass
 
         Returns:
-            (action_dim,) tensor
+            (action_dim,) tensor,
+            () tensor of the log prob and () tensor of the state value if return_info
         """
         mean, cov = self.policy(state)
-        dist = MultivariateNormal(mean, cov)
-        return dist.sample()
-
-    def sample_action_numpy(self, state):
+        if not return_info:
+            dist = MultivariateNormal(mean, cov)
+            return dist.sample()
+
+        # the covariance is diagonal, so the sample and its log prob are computed in closed form instead of
+        # through MultivariateNormal, whose Cholesky factorization costs more than the forward pass of a step
+        std = torch.sqrt(torch.diagonal(cov, dim1=-2, dim2=-1))
+        eps = torch.randn_like(mean)
+        log_prob = -0.5 * torch.sum(eps ** 2, -1) - torch.sum(torch.log(std), -1) - 0.5 * mean.shape[-1] * np.log(2 * np.pi)
+        return mean + std * eps, log_prob, torch.squeeze(self.vf(state))
+
+    def sample_action_numpy(self, state, return_info=False):
         """ Returns an action based on the current policy given state
 
         Args:
             state: (state_dim,) numpy array
+            return_info: whether to also return the log prob of the action and the value of state, to be
+                stored with the step in GAEBuffer.store_numpy instead of evaluating the states again
 
         Returns:
-            (action_dim,) numpy array
+            (action_dim,) numpy array,
+            float log prob and float state value if return_info
         """
         state = torch.Tensor(state).to(device)
-        action = self.sample_action(state)
-        return action.cpu().data.numpy()
+        if not return_info:
+            action = self.sample_action(state)
+            return action.cpu().data.numpy()
+
+        with torch.no_grad():
+            action, log_prob, value = self.sample_action(state, return_info=True)
+            # one copy to the host for all three
+            out = torch.cat((action, log_prob.reshape(1), value.reshape(1))).cpu().numpy()
+        return out[:-2], float(out[-2]), float(out[-1])
 
 def train(agent=None, env=None, episodes=10000, batch_size=4000, save_path=None, save_freq=100, init_ep=0, 
-        lam=0.97, discount=0.99, max_ep_len=1000, eps_clip=0.2, vf_coef=0.5, lr=3e-4, update_steps=80):
+        lam=0.97, discount=0.99, max_ep_len=1000, eps_clip=0.2, vf_coef=0.5, lr=3e-4, update_steps=80,
+        buffer_stats=False, deferred_gae=False, minibatch_size=0, num_epochs=10, target_kl=None):
+
+    # an epoch holds batch_size // minibatch_size minibatches, none would leave PPO without a single step
+    if minibatch_size > batch_size:
+        raise ValueError(f"minibatch_size {minibatch_size} can not be larger than batch_size {batch_size}")
 
-    buffer = GAEBuffer(batch_size, lam, discount, agent.state_dim, agent.action_dim, agent, device)
+    buffer = GAEBuffer(batch_size, lam, discount, agent.state_dim, agent.action_dim, agent, device,
+                       deferred=deferred_gae)
     optimizer = torch.optim.Adam(agent.parameters(), lr=lr)
+    # minibatch epochs instead of update_steps full-batch steps, which bounds the memory of a step by
+    # minibatch_size instead of batch_size
+    sampler = MinibatchSampler(minibatch_size, device) if minibatch_size > 0 else None
 
     def update():
-        old_states, old_actions, old_rewards, old_advs, old_log_probs = buffer.get_buffer()
-
-        for _ in range(update_steps):
-            values, log_probs, entropy = agent.evaluate(old_states, old_actions)
-            
-            # calculate policy loss
-            ratios = torch.exp(log_probs - old_log_probs)
-            bounds = torch.where(old_advs > 0, (1 + eps_clip) * old_advs, (1 - eps_clip) * old_advs)
-            surrogate_losses = torch.min(ratios * old_advs, bounds)
-            # policy_loss = -torch.mean(surrogate_losses)
+        """ Returns the number of update steps taken, fewer than all of them if stopped early by target_kl """
+        batch = buffer.get_buffer()
+        if sampler is None:
+            batches = (batch for _ in range(update_steps))
+        else:
+            batches = (minibatch for _ in range(num_epochs) for minibatch in sampler.epoch(batch))
+        steps = 0
+        for b in batches:
+            if not update_step(*b):
+                break
+            steps += 1
+        return steps
+
+    def update_step(old_states, old_actions, old_rewards, old_advs, old_log_probs):
+        """ One gradient step of the clipped surrogate and value function losses on the given (mini)batch.
+            Returns False without a step if the policy already moved too far from the old one. """
+        values, log_probs, entropy = agent.evaluate(old_states, old_actions)
+
+        # approximate KL divergence of the current policy from the old one, from the log probs the loss needs
+        # anyway. Stops at 1.5 * target_kl, like Spinning Up's PPO
+        if target_kl is not None and torch.mean(old_log_probs - log_probs).item() > 1.5 * target_kl:
+            return False
+        
+        # calculate policy loss
+        ratios = torch.exp(log_probs - old_log_probs)
+        bounds = torch.where(old_advs > 0, (1 + eps_clip) * old_advs, (1 - eps_clip) * old_advs)
+        surrogate_losses = torch.min(ratios * old_advs, bounds)
+        # policy_loss = -torch.mean(surrogate_losses)
 
-            # calculate value function loss
-            vf_squared_error = (values - old_rewards) ** 2
+        # calculate value function loss
+        vf_squared_error = (values - old_rewards) ** 2
 
-            # total loss
-            loss = torch.mean(-surrogate_losses + vf_coef * vf_squared_error - 0.01 * entropy)
+        # total loss
+        loss = torch.mean(-surrogate_losses + vf_coef * vf_squared_error - 0.01 * entropy)
 
-            # optimize one step
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+        # optimize one step
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return True
 
     ep = init_ep
     last_save = ep
@@ -130,8 +181,8 @@ def train(agent=None, env=None, episodes=10000, batch_size=4000, save_path=None,
             # buffer.store(s, a, r)
             # s = new_s
 
-            a = agent.sample_action_numpy(s)
-            buffer.store_numpy(s, a, r)
+            a, log_prob, value = agent.sample_action_numpy(s, return_info=True)
+            buffer.store_numpy(s, a, r, log_prob, value)
             s, r, done, _ = env.step(a)
 
             ep_len += 1
@@ -156,10 +207,14 @@ def train(agent=None, env=None, episodes=10000, batch_size=4000, save_path=None,
                 if buffer.is_full():
                     break
 
-        update()
+        # taken while the batch is still in the buffer, the get_buffer latencies are those of earlier updates
+        stats = buffer.stats(reset=True) if buffer_stats else None
+        steps = update()
 
         end = time.time()
-        print(f"{end - start}s, \t episode: {ep}, \t return: {np.mean(ep_returns)}, \t episode length: {np.mean(ep_lens)} \t {np.exp(agent.policy.log_std.cpu().data.numpy())}")
+        print(f"{end - start}s, \t episode: {ep}, \t return: {np.mean(ep_returns)}, \t episode length: {np.mean(ep_lens)} \t {np.exp(agent.policy.log_std.cpu().data.numpy())} \t update steps: {steps}")
+        if stats is not None:
+            print(format_stats(stats))
         
         if ep - last_save >= save_freq:
             torch.save(agent.state_dict(), f"{save_path}_{ep}.pth")
@@ -191,6 +246,11 @@ if __name__ == '__main__':
     parser.add_argument("--hidden_layers", type=str, default="[128, 64]")
     parser.add_argument("--init_std", type=float, default=0.5)
     parser.add_argument("--eps_clip", type=float, default=0.2)
+    parser.add_argument("--buffer_stats", action="store_true")
+    parser.add_argument("--deferred_gae", action="store_true")
+    parser.add_argument("--minibatch_size", type=int, default=0)
+    parser.add_argument("--num_epochs", type=int, default=10)
+    parser.add_argument("--target_kl", type=float, default=None)
     args = parser.parse_args()
     print(args)
 
@@ -215,7 +275,9 @@ if __name__ == '__main__':
     if args.episodes > 0 and not args.test_only:
         train(agent=agent, env=env, episodes=args.episodes, batch_size=args.bs, save_path=model_path, save_freq=args.save_freq, 
             discount=args.discount, lam=args.lam, init_ep=args.init_ep, max_ep_len=args.max_ep_len, 
-            eps_clip=args.eps_clip, vf_coef=args.vf_coef, lr=args.lr, update_steps=args.update_steps)
+            eps_clip=args.eps_clip, vf_coef=args.vf_coef, lr=args.lr, update_steps=args.update_steps,
+            buffer_stats=args.buffer_stats, deferred_gae=args.deferred_gae,
+            minibatch_size=args.minibatch_size, num_epochs=args.num_epochs, target_kl=args.target_kl)
 
     if args.tests > 0:
         test_agent(agent, env, args.tests, 1.0 / 60.0)
@@ -10,6 +10,15 @@ from core.agents import QFunction
 from core.agents import DeterministicPolicy
 
 from core.buffers import ReplayBuffer
+from core.buffers import PrioritizedReplayBuffer
+from core.buffers import TorchReplayBuffer
+from core.buffers import CompactReplayBuffer
+from core.buffers import NStepReplayBuffer
+from core.buffers import Prefetcher
+from core.buffers import snapshot_exists
+from core.buffers import format_stats
+
+from core.datasets import ShardedDataset
 
 from core.utils import test_agent
 
@@ -124,7 +133,37 @@ class TD3Agent(Agent):
         return np.clip(action + noise, self.action_low, self.action_high)
 
 def train(agent=None, env=None, episodes=10000, buffer_size=1e6, batch_size=100, save_path=None, save_freq=100, init_ep=0, 
-        discount=0.99, max_ep_len=1000, lr=3e-4, polyak=0.995, min_steps_update=500, start_steps=1e4, policy_delay=2):
+        discount=0.99, max_ep_len=1000, lr=3e-4, polyak=0.995, min_steps_update=500, start_steps=1e4, policy_delay=2,
+        buffer_path=None, prioritized=False, per_alpha=0.6, per_beta=0.4, device_buffer=False, zero_copy=False,
+        compact_buffer=False, n_step=1, buffer_dtypes=None, prefetch=0,
+        block_sampling=False, buffer_snapshot=None, dataset=None,
+        ere_eta=1.0, ere_min=2500, buffer_stats=False):
+
+    # each of these picks a different buffer, so combining them would silently drop all but one
+    kinds = [name for name, enabled in (("prioritized", prioritized), ("device_buffer", device_buffer),
+                                        ("n_step", n_step > 1), ("compact_buffer", compact_buffer)) if enabled]
+    if len(kinds) > 1:
+        raise ValueError(f"{' and '.join(kinds)} can not be combined")
+    if block_sampling and prioritized:
+        raise ValueError("priorities change after every batch, block_sampling can not be combined with prioritized")
+    if block_sampling and ere_eta < 1.0:
+        raise ValueError("ERE narrows the window of every step, block_sampling can not be combined with ere_eta < 1")
+    if buffer_snapshot is not None and device_buffer:
+        raise ValueError("snapshots are only supported for numpy buffers, buffer_snapshot can not be combined "
+                         "with device_buffer")
+    # PrioritizedReplayBuffer returns new weights and indices on every call, block_sampling draws its own block
+    if zero_copy and (prioritized or block_sampling):
+        raise ValueError(f"zero_copy can not be combined with {'prioritized' if prioritized else 'block_sampling'}")
+    # the prefetcher samples the uniform batches of a round ahead, before ERE would narrow the window of each step
+    if prefetch > 0:
+        conflicts = [name for name, enabled in (("prioritized", prioritized), ("device_buffer", device_buffer),
+                                                ("block_sampling", block_sampling), ("ere_eta < 1", ere_eta < 1.0))
+                     if enabled]
+        if conflicts:
+            raise ValueError(f"prefetch can not be combined with {' and '.join(conflicts)}")
+    if buffer_snapshot is not None and buffer_path is not None:
+        raise ValueError("a buffer at buffer_path is reopened from its own files after a restart, "
+                         "buffer_snapshot can not be combined with buffer_path")
 
     target = agent.copy().to(device)
     target.load_state_dict(agent.state_dict())
@@ -133,19 +172,83 @@ def train(agent=None, env=None, episodes=10000, buffer_size=1e6, batch_size=100,
     critic1_optimizer = torch.optim.Adam(agent.critic1.parameters(), lr=lr)
     critic2_optimizer = torch.optim.Adam(agent.critic2.parameters(), lr=lr)
     
-    buffer = ReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device)
+    if prioritized:
+        buffer = PrioritizedReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, 
+                                         alpha=per_alpha, beta=per_beta, path=buffer_path, dtypes=buffer_dtypes)
+    elif device_buffer:
+        buffer = TorchReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, dtypes=buffer_dtypes)
+    elif n_step > 1:
+        buffer = NStepReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, n_step, discount, 
+                                   path=buffer_path, dtypes=buffer_dtypes)
+    elif compact_buffer:
+        buffer = CompactReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, path=buffer_path,
+                                     dtypes=buffer_dtypes)
+    else:
+        buffer = ReplayBuffer(buffer_size, agent.state_dim, agent.action_dim, device, path=buffer_path,
+                              dtypes=buffer_dtypes)
+    n_step_returns = isinstance(buffer, NStepReplayBuffer)
+
+    # resume from the last snapshot of the buffer after a preemption, the warmup below skips what it holds
+    if buffer_snapshot is not None and snapshot_exists(buffer_snapshot):
+        buffer.load(buffer_snapshot)
+    elif dataset is not None:
+        # pretrain on logged transitions. A dataset larger than the buffer is stored in random order, so that a
+        # random subset of it stays instead of its end (this loses the order CompactReplayBuffer and
+        # NStepReplayBuffer rely on).
+        data = ShardedDataset(dataset, device)
+        data.fill(buffer, shuffle=data.size > buffer.max_size)
+
+    # preallocated output that sample_torch fills in place on every update step
+    batch = buffer.allocate_batch(batch_size) if zero_copy else None
+
+    # up to prefetch batches are sampled ahead on a background thread while the networks update, the thread is
+    # stopped before collecting again
+    prefetcher = None
+    if prefetch > 0:
+        prefetcher = Prefetcher(buffer, batch_size, prefetch)
+
+    def sample_batch(batches):
+        if batches is not None:
+            return next(batches)
+        if prefetcher is not None:
+            return prefetcher.get()
+        return buffer.sample_torch(batch_size, out=batch)
 
     def update(update_steps):
+        # with block_sampling every batch of the round is drawn at once, then handed out as one view per step
+        batches = None
+        if block_sampling:
+            batches = zip(*(x.unbind(0) for x in buffer.sample_many(update_steps, batch_size)))
+        if prefetcher is not None:
+            prefetcher.start(update_steps)
         for i in range(update_steps):
-            states, actions, rewards, next_states, dones = buffer.sample_torch(batch_size)
+            # Emphasizing Recent Experience: the k-th of K updates samples from the newest size * eta ** (1000 k / K)
+            if ere_eta < 1.0:
+                buffer.recent = max(int(buffer.size * ere_eta ** (1000 * (i + 1) / update_steps)), ere_min)
+
+            if prioritized:
+                states, actions, rewards, next_states, dones, weights, indices = buffer.sample_torch(batch_size)
+                discounts = discount
+            elif n_step_returns:
+                # rewards are n-step returns and discounts are discount ** k for the k steps they cover
+                states, actions, rewards, next_states, dones, discounts = sample_batch(batches)
+                weights = 1.0
+            else:
+                states, actions, rewards, next_states, dones = sample_batch(batches)
+                weights, discounts = 1.0, discount
 
             # calculate targets (after policy smoothing and minimization)
             target_actions = target.target_actions(next_states)
-            target_qs = (rewards + discount * (1.0 - dones) * target.min_q_values(next_states, target_actions)).detach()
+            target_qs = (rewards + discounts * (1.0 - dones) * target.min_q_values(next_states, target_actions)).detach()
+
+            # calcualte q functions losses, weighted by the importance-sampling weights if prioritized
+            critic1_errors = agent.evaluate_q1(states, actions) - target_qs
+            critic2_errors = agent.evaluate_q2(states, actions) - target_qs
+            critic1_loss = torch.mean(weights * critic1_errors ** 2)
+            critic2_loss = torch.mean(weights * critic2_errors ** 2)
 
-            # calcualte q functions losses
-            critic1_loss = torch.mean((agent.evaluate_q1(states, actions) - target_qs) ** 2)
-            critic2_loss = torch.mean((agent.evaluate_q2(states, actions) - target_qs) ** 2)
+            if prioritized:
+                buffer.update_priorities(indices, critic1_errors)
             
             # optimize q one step for both critics
             critic1_optimizer.zero_grad()
@@ -169,12 +272,15 @@ def train(agent=None, env=None, episodes=10000, buffer_size=1e6, batch_size=100,
                 # update target networks
                 for param, target_param in zip(agent.parameters(), target.parameters()):
                     target_param.data.copy_(polyak * target_param.data + (1.0 - polyak) * param.data)
+        if prefetcher is not None:
+            prefetcher.stop()
+        buffer.recent = None
 
-    # Random exploration at the beginning for start_steps
+    # Random exploration at the beginning for start_steps, minus the steps already in a reopened buffer
     print(f"Start steps: {int(start_steps)}")
     s, r, done = env.reset(), 0, False
     ep_len = 0
-    for _ in range(int(start_steps)):
+    for _ in range(max(int(start_steps) - buffer.size, 0)):
         a = env.action_space.sample()
         new_s, r, done, _ = env.step(a)
         buffer.store(s, a, r, new_s, done)
@@ -191,6 +297,10 @@ def train(agent=None, env=None, episodes=10000, buffer_size=1e6, batch_size=100,
     while ep < episodes:
         start = time.time()
 
+        # anneal the importance-sampling exponent towards 1 over the course of training
+        if prioritized:
+            buffer.beta = per_beta + (1.0 - per_beta) * min(ep / episodes, 1.0)
+
         ep_returns = []
         ep_lens = []
         curr_rewards = []
@@ -225,12 +335,18 @@ def train(agent=None, env=None, episodes=10000, buffer_size=1e6, batch_size=100,
 
         end = time.time()
         print(f"{end - start}s, \t episode: {ep}, \t return: {np.mean(ep_returns)}, \t episode length: {np.mean(ep_lens)}")
+        if buffer_stats:
+            print(format_stats(buffer.stats(reset=True)))
         
         if ep - last_save >= save_freq:
             torch.save(agent.state_dict(), f"{save_path}_{ep}.pth")
+            if buffer_snapshot is not None:
+                buffer.save(buffer_snapshot)
             last_save = ep
-        
+
     torch.save(agent.state_dict(), f"{save_path}_{ep}.pth")
+    if buffer_snapshot is not None:
+        buffer.save(buffer_snapshot)
 
 if __name__ == '__main__':
     import argparse, os
@@ -256,6 +372,23 @@ if __name__ == '__main__':
     parser.add_argument("--min_steps_update", type=int, default=0)
     parser.add_argument("--buffer_size", type=int, default=1e6)
     parser.add_argument("--start_steps", type=int, default=1e4)
+    parser.add_argument("--buffer_path", type=str, default=None)
+    parser.add_argument("--buffer_snapshot", type=str, default=None)
+    parser.add_argument("--dataset", type=str, default=None)
+    parser.add_argument("--prioritized", action="store_true")
+    parser.add_argument("--per_alpha", type=float, default=0.6)
+    parser.add_argument("--per_beta", type=float, default=0.4)
+    parser.add_argument("--device_buffer", action="store_true")
+    parser.add_argument("--zero_copy", action="store_true")
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--block_sampling", action="store_true")
+    parser.add_argument("--ere_eta", type=float, default=1.0)
+    parser.add_argument("--ere_min", type=int, default=2500)
+    parser.add_argument("--buffer_stats", action="store_true")
+    parser.add_argument("--compact_buffer", action="store_true")
+    parser.add_argument("--n_step", type=int, default=1)
+    parser.add_argument("--obs_dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--done_dtype", type=str, default="float32", choices=["float32", "uint8"])
     parser.add_argument("--policy_delay", type=int, default=2)
     parser.add_argument("--target_noise", type=float, default=0.2)
     parser.add_argument("--noise_clip", type=float, default=0.5)
@@ -263,6 +396,8 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
     print(args)
+    if args.obs_dtype == "bfloat16" and not args.device_buffer:
+        parser.error("--obs_dtype bfloat16 requires --device_buffer, numpy has no bfloat16")
 
     env = gym.make(args.env)
 
@@ -288,7 +423,13 @@ if __name__ == '__main__':
         train(agent=agent, env=env, episodes=args.episodes, batch_size=args.bs, save_path=model_path, save_freq=args.save_freq, 
             discount=args.discount, init_ep=args.init_ep, max_ep_len=args.max_ep_len, lr=args.lr, polyak=args.polyak,
             min_steps_update=args.min_steps_update, buffer_size=args.buffer_size, start_steps=args.start_steps, 
-            policy_delay=args.policy_delay)
+            policy_delay=args.policy_delay, buffer_path=args.buffer_path, prioritized=args.prioritized, 
+            per_alpha=args.per_alpha, per_beta=args.per_beta, device_buffer=args.device_buffer,
+            zero_copy=args.zero_copy, compact_buffer=args.compact_buffer, n_step=args.n_step,
+            buffer_dtypes={"states": args.obs_dtype, "next_states": args.obs_dtype, "dones": args.done_dtype},
+            prefetch=args.prefetch, block_sampling=args.block_sampling,
+            buffer_snapshot=args.buffer_snapshot, dataset=args.dataset,
+            ere_eta=args.ere_eta, ere_min=args.ere_min, buffer_stats=args.buffer_stats)
 
     if args.tests > 0:
         test_agent(agent, env, args.tests, 1.0 / 60.0, bullet=args.bullet)